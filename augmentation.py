@@ -0,0 +1,86 @@
+"""
+Video augmentation of minibatches
+
+Random parameters are drawn for the whole minibatch (N, C, T, H, W) at
+once. Each video is then written to the output in one strided copy:
+flips and temporal reversal are reversed views, and the crop is a shift
+whose gap is filled by replicating the edge rows/columns, which is the
+same as cropping an edge-padded frame without building the padded copy.
+A video fits in cache, so this beats transforming the whole minibatch
+with gathers or where(), which stream it through memory several times.
+"""
+import numpy as np
+import chainer
+
+AUGMENTATIONS = ('flip', 'reverse', 'crop', 'brightness')
+
+def shift_slices(s, n):
+    """
+    slices of a shift by s along an axis of length n with edge replication
+    :return: (destination, source, gap, edge)
+    """
+    if s >= 0:
+        return slice(0, n - s), slice(s, n), slice(n - s, n), slice(n - s - 1, n - s)
+    return slice(-s, n), slice(0, n + s), slice(0, -s), slice(-s, 1 - s)
+
+class VideoAugmentation(object):
+    def __init__(self, flip=False, reverse=False, crop_pad=0, brightness=0.):
+        """
+        :param bool flip: horizontally flip half of the videos
+        :param bool reverse: play half of the videos backwards
+        :param int crop_pad: random crop after (edge) padding this many pixels
+        :param float brightness: add a per-video offset in [-brightness, brightness]
+        """
+        self.flip = flip
+        self.reverse = reverse
+        self.crop_pad = crop_pad
+        self.brightness = brightness
+
+    def __call__(self, x):
+        """
+        :param x: videos, shape: (N, C, T, H, W), value range: [-1, 1]
+        """
+        xp = chainer.cuda.get_array_module(x)
+        N, C, T, H, W = x.shape
+        p = self.crop_pad
+
+        reverse = np.random.rand(N) < 0.5 if self.reverse else np.zeros(N, dtype=bool)
+        flip    = np.random.rand(N) < 0.5 if self.flip else np.zeros(N, dtype=bool)
+        oy, ox  = np.random.randint(-p, p + 1, size=(2, N))
+        delta   = np.random.uniform(-self.brightness, self.brightness, size=N).astype(x.dtype)
+
+        out = xp.empty_like(x)
+        for i in range(N):
+            v = x[i]
+            if reverse[i]:
+                v = v[:, ::-1]
+            if flip[i]:
+                v = v[:, :, :, ::-1]
+
+            # shifted copy, then replicate the edge rows/columns into the gap
+            o = out[i]
+            yd, ys, yf, ye = shift_slices(oy[i], H)
+            xd, xs, xf, xe = shift_slices(ox[i], W)
+            o[:, :, yd, xd] = v[:, :, ys, xs]
+            o[:, :, yd, xf] = o[:, :, yd, xe]
+            o[:, :, yf] = o[:, :, ye]
+
+            if self.brightness > 0:
+                o += delta[i]
+                # x is in [-1, 1], so only one side can overflow
+                if delta[i] > 0:
+                    xp.minimum(o, 1., out=o)
+                else:
+                    xp.maximum(o, -1., out=o)
+
+        return out
+
+    @classmethod
+    def from_names(cls, names, crop_pad=4, brightness=0.1):
+        """ build from a list of names in AUGMENTATIONS """
+        for name in names:
+            if name not in AUGMENTATIONS:
+                raise ValueError('unknown augmentation: {}'.format(name))
+        return cls('flip' in names, 'reverse' in names,
+                   crop_pad if 'crop' in names else 0,
+                   brightness if 'brightness' in names else 0.)
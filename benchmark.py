@@ -0,0 +1,511 @@
+"""
+Micro benchmarks
+
+  python benchmark.py augment [--batchsize 64]
+  python benchmark.py progressive [--batchsize 16] [--fvd <target fvd> --max_time 1800]
+  python benchmark.py decode [--clip <frame directory>]
+  python benchmark.py clip [--clip <frame directory>]
+  python benchmark.py backend [--backend ideep] [--batchsize 4]
+  python benchmark.py gru [--lengths 16 64 256] [--batchsizes 16 256]
+"""
+import argparse
+import time
+
+import numpy as np
+
+def timeit(func, repeat=5, number=1):
+    """ return the best seconds per call """
+    func()  # warm up
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - start) / number)
+
+    return best
+
+def print_table(header, rows):
+    widths = [max(len(str(v)) for v in col) for col in zip(header, *rows)]
+    fmt = '  '.join('{:>%d}' % w for w in widths)
+    print(fmt.format(*header))
+    for row in rows:
+        print(fmt.format(*row))
+    print('')
+
+# {{{ augment
+def augment_per_sample(x, crop_pad, brightness):
+    """ straightforward baseline of augmentation.VideoAugmentation (np.pad, clip) """
+    N, C, T, H, W = x.shape
+    out = np.empty_like(x)
+    for i in range(N):
+        v = x[i]
+        if np.random.rand() < 0.5:
+            v = v[:, ::-1]
+        if np.random.rand() < 0.5:
+            v = v[:, :, :, ::-1]
+        v = np.pad(v, ((0, 0), (0, 0), (crop_pad, crop_pad), (crop_pad, crop_pad)), mode='edge')
+        oy, ox = np.random.randint(0, 2*crop_pad + 1, size=2)
+        v = v[:, :, oy:oy+H, ox:ox+W]
+        v = v + np.random.uniform(-brightness, brightness)
+        out[i] = np.clip(v, -1., 1.)
+
+    return out
+
+def bench_augment(args):
+    from augmentation import VideoAugmentation
+
+    aug = VideoAugmentation(True, True, args.crop_pad, args.brightness)
+    x = np.random.uniform(-1, 1, size=(args.batchsize, 3, 16, 64, 64)).astype(np.float32)
+
+    t_batch  = timeit(lambda: aug(x), args.repeat)
+    t_sample = timeit(lambda: augment_per_sample(x, args.crop_pad, args.brightness), args.repeat)
+
+    print('[ augmentation: flip, reverse, crop, brightness / batch {} ]'.format(args.batchsize))
+    print_table(('method', 'ms/batch', 'videos/s'), [
+        ('np.pad baseline',   '{:.2f}'.format(1e3*t_sample), '{:.0f}'.format(args.batchsize/t_sample)),
+        ('VideoAugmentation', '{:.2f}'.format(1e3*t_batch), '{:.0f}'.format(args.batchsize/t_batch)),
+    ])
+# }}}
+
+# {{{ progressive
+def bench_progressive(args):
+    import chainer
+    import chainer.functions as F
+    from model.net import ImageGenerator, ImageDiscriminator, VideoDiscriminator
+
+    image_gen = ImageGenerator(progressive=True)
+    image_dis = ImageDiscriminator(use_noise=True, progressive=True)
+    video_dis = VideoDiscriminator(use_noise=True, progressive=True)
+    nets = (image_gen, image_dis, video_dis)
+    if args.gpu >= 0:
+        chainer.cuda.get_device_from_id(args.gpu).use()
+        for net in nets:
+            net.to_gpu()
+    xp = np if args.gpu < 0 else chainer.cuda.cupy
+
+    def step(img_size, video_length):
+        x_real = xp.random.uniform(-1, 1, (args.batchsize, 3, video_length, img_size, img_size))
+        x_real = chainer.Variable(x_real.astype(np.float32))
+        x_fake, _ = image_gen(args.batchsize, xp)
+        x_fake = F.transpose(x_fake, (1, 2, 0, 3, 4))
+        loss = F.sum(F.softplus(-image_dis(x_real[:, :, 0]))) + F.sum(F.softplus(image_dis(x_fake[:, :, 0])))
+        loss += F.sum(F.softplus(-video_dis(x_real))) + F.sum(F.softplus(video_dis(x_fake)))
+        for net in nets:
+            net.cleargrads()
+        loss.backward()
+
+    rows = []
+    stages = [(32, 8, 1.0), (32, 16, 1.0), (64, 16, 0.5), (64, 16, 1.0)]
+    for img_size, video_length, alpha in stages:
+        image_gen.img_size, image_gen.video_len = img_size, video_length
+        for net in nets:
+            net.alpha = alpha
+        t = timeit(lambda: step(img_size, video_length), args.repeat)
+        rows.append(('{}x{}'.format(img_size, img_size), video_length,
+                     'fade' if alpha < 1 else '-', '{:.1f}'.format(1e3*t), '{:.2f}'.format(1/t)))
+
+    print('[ progressive stages: forward + backward of all nets / batch {} ]'.format(args.batchsize))
+    print_table(('size', 'frames', 'fade', 'ms/iter', 'iter/s'), rows)
+
+    if args.fvd > 0:
+        bench_time_to_fvd(args)
+
+def make_moving_squares(num, video_length=16, size=64, seed=0):
+    """ synthetic dataset of squares moving at a constant velocity, one color per clip """
+    import json
+    import chainer
+
+    rng = np.random.RandomState(seed)
+    clips = [(rng.randint(8, size//4), rng.uniform(0, size, 2), rng.uniform(-3, 3, 2), rng.uniform(-1, 1, 3))
+             for _ in range(num)]
+
+    class MovingSquares(chainer.dataset.DatasetMixin):
+        def __init__(self):
+            self.video_length = video_length
+
+        def __len__(self):
+            return num
+
+        def manifest(self):
+            return json.dumps({'moving_squares': [num, video_length, size, seed]})
+
+        def get_example(self, i):
+            side, pos, velocity, color = clips[i]
+            video = -np.ones((3, video_length, size, size), dtype=np.float32)
+            for t in range(video_length):
+                y, x = ((pos + t * velocity) % (size - side)).astype(np.int32)
+                video[:, t, y:y+side, x:x+side] = color[:, None, None]
+            return video, 0
+
+    return MovingSquares()
+
+def bench_time_to_fvd(args):
+    """
+    Train from the same initial state with and without progressive training
+    and report the training time (evaluations excluded) until the FVD of
+    generated videos drops below args.fvd
+    """
+    import tempfile
+    import chainer
+    from datasets import MugDataset
+    from evaluation import FeatureExtractor, FrechetEvaluator
+    from model.net import ImageGenerator, ImageDiscriminator, VideoDiscriminator
+    from model.updater import Updater, ProgressiveSchedule
+    from summary_writer import SummaryWriter
+
+    if args.dataset_type == 'mug':
+        dataset = MugDataset(args.dataset, 16, 64)
+    else:
+        dataset = make_moving_squares(args.num_videos)
+    xp = np if args.gpu < 0 else chainer.cuda.cupy
+
+    extractor = FeatureExtractor(3, args.fid_image_dis, args.fid_video_dis)
+    if args.gpu >= 0:
+        extractor.to_gpu()
+
+    def train(progressive, evaluator, writer):
+        np.random.seed(0)
+        nets = (ImageGenerator(n_filters=args.n_filters, progressive=progressive),
+                ImageDiscriminator(n_filters=args.n_filters, use_noise=True, progressive=progressive),
+                VideoDiscriminator(n_filters=args.n_filters, use_noise=True, progressive=progressive))
+        optimizers = {}
+        for key, net in zip(('image_gen', 'image_dis', 'video_dis'), nets):
+            if args.gpu >= 0:
+                net.to_gpu()
+            optimizer = chainer.optimizers.Adam(alpha=2e-4, beta1=5e-5)
+            optimizer.setup(net)
+            optimizer.add_hook(chainer.optimizer.WeightDecay(1e-5), 'hook_dec')
+            optimizers[key] = optimizer
+
+        updater = Updater(model='normal', models=nets, video_length=16, img_size=64, channel=3, dim_zl=0,
+                          iterator=chainer.iterators.SerialIterator(dataset, args.batchsize),
+                          tensorboard_writer=writer, optimizer=optimizers, device=args.gpu)
+        schedule = None
+        if progressive:
+            schedule = ProgressiveSchedule(updater, args.stage_epochs, args.fade_epochs)
+
+        elapsed, fvd = 0., float('inf')
+        while elapsed < args.max_time:
+            start = time.perf_counter()
+            for _ in range(args.eval_interval):
+                if schedule is not None:
+                    schedule.apply(updater.epoch_detail)
+                updater.update()
+            elapsed += time.perf_counter() - start
+
+            _, fvd = evaluator.evaluate(nets[0], args.fid_samples, xp)
+            print('  progressive={} iteration {} ({:.1f} epochs, {}x{}): {:.1f} s, fvd {:.4g}'.format(
+                progressive, updater.iteration, updater.epoch_detail, updater.img_size, updater.img_size,
+                elapsed, fvd))
+            if fvd <= args.fvd:
+                return updater.iteration, elapsed, fvd
+
+        return updater.iteration, None, fvd
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        writer = SummaryWriter(tmp)
+        evaluator = FrechetEvaluator(extractor, dataset, args.batchsize, tmp, args.gpu)
+        for progressive in (False, True):
+            iteration, elapsed, fvd = train(progressive, evaluator, writer)
+            rows.append(('progressive' if progressive else 'full size', iteration,
+                         'not reached' if elapsed is None else '{:.1f}'.format(elapsed), '{:.4g}'.format(fvd)))
+        writer.close()
+
+    print('[ training time to fvd <= {:g} / batch {}, {} filters ]'.format(args.fvd, args.batchsize, args.n_filters))
+    print_table(('training', 'iterations', 'seconds', 'fvd'), rows)
+# }}}
+
+# {{{ decode
+def read_video_serial(paths):
+    """ baseline: the former serial float32 read_video """
+    from PIL import Image
+
+    video = []
+    for path in paths:
+        f = Image.open(path)
+        try:
+            video.append(np.asarray(f, dtype=np.float32))
+        finally:
+            f.close()
+
+    return np.asarray(video, dtype=np.float32)
+
+def make_clip(path, size, length=16):
+    """ write a synthetic clip of smooth jpeg frames """
+    from PIL import Image
+
+    path.mkdir(parents=True, exist_ok=True)
+    y, x = np.mgrid[0:size, 0:size] / size
+    for t in range(length):
+        img = np.stack([np.sin(6*x + t/4.), np.cos(5*y - t/5.), np.sin(4*(x+y) + t/3.)], axis=2)
+        img = ((img + 1) * 127.5).astype(np.uint8)
+        Image.fromarray(img).save(str(path / '{:02d}.jpg'.format(t+1)), quality=90)
+
+    return sorted(path.glob('*.jpg'))
+
+def bench_decode(args):
+    import tempfile
+    from pathlib import Path
+    from datasets import read_video
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.clip:
+            clips = [('given', sorted(Path(args.clip).glob('*.jpg')))]
+        else:
+            clips = [('{}x{}'.format(s, s), make_clip(Path(tmp) / str(s), s)) for s in (64, 256)]
+
+        rows = []
+        for name, paths in clips:
+            def normalized(video):
+                return (video.astype(np.float32) - 128.) / 128.
+            cases = [
+                ('serial float32', lambda: read_video_serial(paths)),
+                ('threads=1',      lambda: normalized(read_video(paths, num_threads=1))),
+                ('threads={}'.format(args.threads), lambda: normalized(read_video(paths, num_threads=args.threads))),
+                ('threads={} draft {}'.format(args.threads, args.size),
+                                   lambda: normalized(read_video(paths, args.size, args.threads))),
+            ]
+            for case, func in cases:
+                t = timeit(func, args.repeat, number=10)
+                rows.append((name, len(paths), case, '{:.2f}'.format(1e3*t)))
+
+    print('[ per-clip decode latency ]')
+    print_table(('clip', 'frames', 'method', 'ms/clip'), rows)
+# }}}
+
+# {{{ clip
+def disk_usage(paths):
+    """ return (sum of file sizes, allocated bytes) """
+    import os
+    stats = [os.stat(str(p)) for p in paths]
+    return sum(s.st_size for s in stats), sum(s.st_blocks * 512 for s in stats)
+
+def bench_clip(args):
+    import tempfile
+    from pathlib import Path
+    from datasets import read_video
+    from clipfile import write_clip, ClipReader
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.clip:
+            paths = sorted(Path(args.clip).glob('*.jpg'))
+        else:
+            paths = make_clip(Path(tmp) / 'jpeg', 64, 32)
+        video = read_video(paths, num_threads=1)
+        T = len(video)
+
+        rows = []
+        jpeg_size, jpeg_alloc = disk_usage(paths)
+        for L in (16, 8):
+            if L > T:
+                continue
+            idx = np.arange(L)
+            t = timeit(lambda: read_video([paths[i] for i in idx], num_threads=args.threads), args.repeat, 10)
+            rows.append(('jpeg dir', L, '{:.1f}'.format(jpeg_size/1024.),
+                         '{:.1f}'.format(jpeg_alloc/1024.), '{:.2f}'.format(1e3*t), '-'))
+
+        for K, quality in ((8, 0), (16, 0), (8, 90), (16, 90), (8, 95)):
+            clip_path = Path(tmp) / 'k{}_q{}.clip'.format(K, quality)
+            write_clip(clip_path, video, K, quality)
+            size, alloc = disk_usage([clip_path])
+            reader = ClipReader(clip_path)
+            err = np.abs(reader.read(np.arange(T)).astype(np.int16) - video).mean()
+            if quality == 0 and err != 0:
+                raise RuntimeError('clip round trip failed')
+            name = 'clip K={}'.format(K) + ('' if quality == 0 else ' q={}'.format(quality))
+            for L in (16, 8):
+                if L > T:
+                    continue
+                # window starting in the middle of a group, the worst case
+                start = min(K // 2, T - L)
+                idx = np.arange(start, start + L)
+                t = timeit(lambda: ClipReader(clip_path).read(idx), args.repeat, 10)
+                rows.append((name, L, '{:.1f}'.format(size/1024.), '{:.1f}'.format(alloc/1024.),
+                             '{:.2f}'.format(1e3*t), 'lossless' if quality == 0 else '{:.2f}'.format(err)))
+
+    print('[ clip storage: {} frames of {} ]'.format(T, 'x'.join(map(str, video.shape[1:]))))
+    print_table(('format', 'window', 'KiB', 'KiB on disk', 'ms/window', 'mean abs err'), rows)
+# }}}
+
+# {{{ backend
+def layer_inputs(n_filters, batchsize, video_len=16):
+    """ (net, layer, input shape) of each layer at 64x64, 16 frames """
+    F_ = n_filters
+    gen = [('bn1', (F_*8, 4, 4)), ('dc2', (F_*8, 4, 4)), ('dc3', (F_*4, 8, 8)),
+           ('dc4', (F_*2, 16, 16)), ('dc5', (F_, 32, 32))]
+    idis = [('dc1', (3, 64, 64)), ('dc2', (F_, 32, 32)), ('dc3', (F_*2, 16, 16)),
+            ('dc4', (F_*4, 8, 8)), ('dc5', (F_*8, 4, 4))]
+    T = video_len
+    vdis = [('dc1', (3, T, 64, 64)), ('dc2', (F_, T-3, 32, 32)), ('dc3', (F_*2, T-6, 16, 16)),
+            ('dc4', (F_*4, T-9, 8, 8)), ('dc5', (F_*8, T-12, 4, 4))]
+
+    return ([('ImageGenerator', name, (batchsize*T,) + s) for name, s in gen] +
+            [('ImageDiscriminator', name, (batchsize*T,) + s) for name, s in idis] +
+            [('VideoDiscriminator', name, (batchsize,) + s) for name, s in vdis])
+
+def bench_backend(args):
+    import copy
+    import chainer
+    import chainer.functions as F
+    from model.net import ImageGenerator, ImageDiscriminator, VideoDiscriminator
+    from chainer.utils import conv_nd
+    from model.backend import use_backend, select_kernels
+
+    default = {net.name: net for net in (ImageGenerator(n_filters=args.n_filters),
+                                         ImageDiscriminator(n_filters=args.n_filters),
+                                         VideoDiscriminator(n_filters=args.n_filters))}
+    selected = copy.deepcopy(default)
+    backend = use_backend(args.backend)
+    kernels = {name: dict(select_kernels(net, backend)) for name, net in selected.items()}
+
+    def step(net, name, x):
+        link = getattr(net, name)
+        if isinstance(net, VideoDiscriminator):
+            y = net.conv(link, x, conv_nd.as_tuple(link.pad, 3)[0])
+        else:
+            y = link(x)
+        net.cleargrads()
+        F.sum(y).backward()
+
+    rows = []
+    total = [0., 0.]
+    for net_name, name, shape in layer_inputs(args.n_filters, args.batchsize):
+        x = np.random.uniform(-1, 1, shape).astype(np.float32)
+        with chainer.using_config('use_ideep', 'never'):
+            t_numpy = timeit(lambda: step(default[net_name], name, chainer.Variable(x)), args.repeat)
+        t_backend = timeit(lambda: step(selected[net_name], name, chainer.Variable(x)), args.repeat)
+        total[0] += t_numpy
+        total[1] += t_backend
+        rows.append((net_name, name, 'x'.join(map(str, shape)), kernels[net_name][name],
+                     '{:.2f}'.format(1e3*t_numpy), '{:.2f}'.format(1e3*t_backend),
+                     '{:.2f}'.format(t_numpy/t_backend)))
+    rows.append(('total', '', '', '', '{:.2f}'.format(1e3*total[0]), '{:.2f}'.format(1e3*total[1]),
+                 '{:.2f}'.format(total[0]/total[1])))
+
+    print('[ per layer forward + backward: numpy vs {} / batch {} ]'.format(backend, args.batchsize))
+    print_table(('net', 'layer', 'input', 'kernel', 'numpy ms', '{} ms'.format(backend), 'speedup'), rows)
+# }}}
+
+# {{{ gru
+def make_zm_per_step(gen, h0, eps, zl=None):
+    """
+    baseline: the former make_zm, one g0 (StatelessGRU) call per frame
+    (stacked with transpose_sequence, see ImageGenerator.recur_motion)
+    """
+    import chainer.functions as F
+
+    N, D = h0.shape
+    ht = [h0]
+    for t in range(len(eps)):
+        et = eps[t]
+        if zl is not None:
+            et = np.concatenate((zl, et), axis=1)
+        ht.append(gen.g0(ht[-1], et))
+
+    zm, = F.transpose_sequence([F.reshape(hk, (1, N*D)) for hk in ht[1:]])
+    return F.reshape(zm, (len(eps), N, D))
+
+def bench_gru(args):
+    import chainer
+    import chainer.functions as F
+    from model.net import ImageGenerator
+
+    gen = ImageGenerator(dim_zl=args.dim_zl)
+    D = gen.dim_zm
+
+    rows = []
+    for T in args.lengths:
+        for N in args.batchsizes:
+            h0 = chainer.Variable(gen.make_hidden(N, D))
+            eps = np.random.normal(0, 0.33, (T, N, D)).astype(np.float32)
+            zl = None
+            if gen.use_label:
+                zl = gen.to_one_hot(np.random.randint(args.dim_zl, size=N), np)
+
+            def per_step():
+                return make_zm_per_step(gen, h0, eps, zl)
+            def fused():
+                return gen.make_zm(N, zl, np, h0, eps)
+            def train(func):
+                def step():
+                    gen.cleargrads()
+                    F.sum(func()).backward()
+                return step
+
+            diff = float(abs(per_step().data - fused().data).max())
+            with chainer.no_backprop_mode():
+                t_infer = [timeit(f, args.repeat) for f in (per_step, fused)]
+            t_train = [timeit(train(f), args.repeat) for f in (per_step, fused)]
+            rows.append((T, N, '{:.1e}'.format(diff),
+                         '{:.2f}'.format(1e3*t_infer[0]), '{:.2f}'.format(1e3*t_infer[1]),
+                         '{:.2f}'.format(t_infer[0]/t_infer[1]),
+                         '{:.2f}'.format(1e3*t_train[0]), '{:.2f}'.format(1e3*t_train[1]),
+                         '{:.2f}'.format(t_train[0]/t_train[1])))
+
+    print('[ motion GRU: per-step g0 vs fused, dim_zm {}, dim_zl {} ]'.format(D, args.dim_zl))
+    print_table(('frames', 'batch', 'max diff', 'infer ms', 'fused ms', 'speedup',
+                 'train ms', 'fused ms', 'speedup'), rows)
+# }}}
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro benchmarks')
+    parser.add_argument('--repeat', type=int, default=5, help='num timing repeats')
+    subparsers = parser.add_subparsers(dest='bench')
+
+    p = subparsers.add_parser('augment', help='VideoAugmentation vs a np.pad baseline')
+    p.add_argument('--batchsize', type=int, default=64)
+    p.add_argument('--crop_pad', type=int, default=4)
+    p.add_argument('--brightness', type=float, default=0.1)
+    p.set_defaults(func=bench_augment)
+
+    p = subparsers.add_parser('progressive', help='iteration time of each progressive stage and time to a target fvd')
+    p.add_argument('--batchsize', type=int, default=16)
+    p.add_argument('--gpu', '-g', type=int, default=-1)
+    p.add_argument('--fvd', type=float, default=0, help='target fvd of the timed training runs (0: skip them)')
+    p.add_argument('--max_time', type=float, default=1800, help='max training seconds per run')
+    p.add_argument('--eval_interval', type=int, default=50, help='num iterations between fvd evaluations')
+    p.add_argument('--fid_samples', type=int, default=256, help='num generated videos per evaluation')
+    p.add_argument('--fid_image_dis', default='', help='image discriminator weights used as frame feature extractor')
+    p.add_argument('--fid_video_dis', default='', help='video discriminator weights used as video feature extractor')
+    p.add_argument('--n_filters', type=int, default=64)
+    p.add_argument('--stage_epochs', type=float, default=10, help='num epochs of the low resolution stage')
+    p.add_argument('--fade_epochs', type=float, default=2, help='num epochs to fade in full resolution')
+    p.add_argument('--dataset_type', choices=['squares', 'mug'], default='squares',
+                   help='squares: synthetic moving squares')
+    p.add_argument('--dataset', default='', help='dataset root path (mug)')
+    p.add_argument('--num_videos', type=int, default=128, help='num synthetic videos')
+    p.set_defaults(func=bench_progressive)
+
+    p = subparsers.add_parser('decode', help='per-clip jpeg decode latency')
+    p.add_argument('--clip', default='', help='directory of jpeg frames (synthetic clips if empty)')
+    p.add_argument('--threads', type=int, default=4)
+    p.add_argument('--size', type=int, default=64, help='target size of draft decoding')
+    p.set_defaults(func=bench_decode)
+
+    p = subparsers.add_parser('clip', help='size and decode time of .clip files vs jpeg frames')
+    p.add_argument('--clip', default='', help='directory of jpeg frames (synthetic clip if empty)')
+    p.add_argument('--threads', type=int, default=4, help='decode threads of the jpeg reader')
+    p.set_defaults(func=bench_clip)
+
+    p = subparsers.add_parser('backend', help='per layer time of the default numpy path vs a CPU backend')
+    p.add_argument('--backend', default='ideep')
+    p.add_argument('--batchsize', type=int, default=4)
+    p.add_argument('--n_filters', type=int, default=64)
+    p.set_defaults(func=bench_backend)
+
+    p = subparsers.add_parser('gru', help='per-step vs fused motion GRU')
+    p.add_argument('--lengths', type=int, nargs='+', default=[16, 64, 256])
+    p.add_argument('--batchsizes', type=int, nargs='+', default=[16, 256])
+    p.add_argument('--dim_zl', type=int, default=0, help='num labels (0: unconditional)')
+    p.set_defaults(func=bench_gru)
+
+    args = parser.parse_args()
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        return
+    args.func(args)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Temporally predicted clip container (.clip)
+
+A clip of T uint8 frames (T, H, W, C) is stored as groups of
+keyframe_interval frames: the first frame of a group is stored on its own
+and every other frame as its difference to the previous frame. Consecutive
+face crops differ little, so the differences compress far better than the
+frames themselves.
+
+Two codecs:
+    lossless (quality 0)  frames and differences (modulo 256) compressed with zlib
+    lossy    (quality q)  keyframes and differences compressed as JPEG at quality q;
+                          differences are taken to the previous *decoded* frame,
+                          so the error does not build up along a group
+
+Layout (little endian):
+    header   magic 'MCLP', version, T, H, W, C, keyframe_interval, quality (uint16)
+    offsets  T+1 uint64, byte offset of each compressed frame after the table
+    frames   zlib or JPEG streams
+
+Any frame only depends on the frames before it in its group, so reading a
+sub-sequence decodes each touched group from its keyframe up to the last
+requested frame.
+"""
+import io
+import struct
+import zlib
+
+import numpy as np
+from PIL import Image
+
+MAGIC = b'MCLP'
+VERSION = 2
+HEADER = struct.Struct('<4s7H')
+
+def encode_jpeg(frame, quality):
+    f = io.BytesIO()
+    Image.fromarray(frame[:, :, 0] if frame.shape[2] == 1 else frame).save(f, 'JPEG', quality=quality)
+    return f.getvalue()
+
+def decode_jpeg(blob, frame_shape):
+    f = Image.open(io.BytesIO(blob))
+    try:
+        return np.asarray(f, dtype=np.uint8).reshape(frame_shape)
+    finally:
+        f.close()
+
+def encode_frame(frame, prev, quality, level=6):
+    """
+    :param np.ndarray frame: uint8 frame (H, W, C)
+    :param np.ndarray prev: previously decoded frame of the group, None for a keyframe
+    :return: compressed frame and the frame as decoded by decode_frame
+    """
+    if quality == 0:
+        delta = frame if prev is None else frame - prev # uint8 arithmetic wraps around
+        return zlib.compress(delta.tobytes(), level), frame
+
+    if prev is None:
+        blob = encode_jpeg(frame, quality)
+    else:
+        # half the difference, so that it fits a uint8 image around 128
+        delta = (frame.astype(np.int16) - prev) // 2 + 128
+        blob = encode_jpeg(np.clip(delta, 0, 255).astype(np.uint8), quality)
+
+    return blob, decode_frame(blob, prev, quality, frame.shape)
+
+def decode_frame(blob, prev, quality, frame_shape):
+    if quality == 0:
+        delta = np.frombuffer(zlib.decompress(blob), dtype=np.uint8).reshape(frame_shape)
+        return delta if prev is None else prev + delta
+
+    frame = decode_jpeg(blob, frame_shape)
+    if prev is None:
+        return frame
+    frame = prev + 2 * (frame.astype(np.int16) - 128)
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+def write_clip(path, video, keyframe_interval=8, quality=0, level=6):
+    """
+    :param pathlib.Path path: path to save the clip
+    :param np.ndarray video: video (dim=4, dtype=np.uint8, axis=(video_len, height, width, channel))
+    :param int quality: JPEG quality of the lossy codec, 0: lossless
+    """
+    video = np.ascontiguousarray(video, dtype=np.uint8)
+    T, H, W, C = video.shape
+    if quality and C not in (1, 3):
+        raise ValueError('lossy clips need 1 or 3 channels: {}'.format(C))
+
+    blobs, prev = [], None
+    for t in range(T):
+        if t % keyframe_interval == 0:
+            prev = None
+        blob, prev = encode_frame(video[t], prev, quality, level)
+        blobs.append(blob)
+
+    offsets = np.zeros(T + 1, dtype='<u8')
+    offsets[1:] = np.cumsum([len(b) for b in blobs])
+
+    with open(str(path), 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, T, H, W, C, keyframe_interval, quality))
+        f.write(offsets.tobytes())
+        for b in blobs:
+            f.write(b)
+
+class ClipReader(object):
+    def __init__(self, path):
+        self.path = path
+        with open(str(path), 'rb') as f:
+            magic, version, T, H, W, C, K, quality = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('invalid clip file (version {}, rerun preprocess.py): {}'.format(version, path))
+            self.offsets = np.frombuffer(f.read(8 * (T + 1)), dtype='<u8').astype(np.int64)
+        self.length = T
+        self.shape = (T, H, W, C)
+        self.keyframe_interval = K
+        self.quality = quality
+        self.data_start = HEADER.size + 8 * (T + 1)
+
+    def __len__(self):
+        return self.length
+
+    def read(self, indices):
+        """
+        Decode the given frames
+
+        :param indices: frame indices
+        :return: video (dim=4, dtype=np.uint8, axis=(len(indices), height, width, channel))
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        K = self.keyframe_interval
+
+        # last requested frame of each touched group
+        last = {}
+        for i in indices:
+            last[i // K] = max(last.get(i // K, i), i)
+
+        # one contiguous read covering all needed frames
+        first = min(last) * K
+        start, end = self.offsets[first], self.offsets[max(last.values()) + 1]
+        with open(str(self.path), 'rb') as f:
+            f.seek(self.data_start + start)
+            data = f.read(end - start)
+
+        frame_shape = self.shape[1:]
+        frames = {}
+        for group, j in last.items():
+            prev = None
+            for i in range(group * K, j + 1):
+                blob = data[self.offsets[i] - start:self.offsets[i+1] - start]
+                prev = frames[i] = decode_frame(blob, prev, self.quality, frame_shape)
+
+        return np.stack([frames[i] for i in indices])
@@ -0,0 +1,118 @@
+"""
+Serve a preprocessed dataset from shared memory
+
+The dataset is decoded once into a shared memory segment as uint8 frames,
+and any number of training processes on this machine attach to it
+read-only (train.py --dataset_type shm --dataset <name>, see
+datasets.SharedMemoryDataset). Memory use and decoding work do not grow
+with the number of training jobs.
+
+    python dataset_host.py mug data/dataset/train --name mocogan_mug
+
+The segment is removed when the host is stopped (Ctrl-C / SIGTERM).
+Running jobs keep their mapping, but new jobs can not attach anymore.
+"""
+import argparse
+import glob
+import hashlib
+import os, sys
+import signal
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from clipfile import ClipReader
+from datasets import MugDataset, MovingMnistDataset, read_video, frame_number
+from datasets import shared_memory_layout, write_shared_header, shared_memory_views
+from evaluation import dataset_manifest
+
+def clip_frames(video_path):
+    """ return (num frames, function decoding all frames) of a clip """
+    video_path = Path(video_path)
+    if video_path.suffix == '.clip':
+        reader = ClipReader(video_path)
+        return len(reader), lambda size, num_threads: reader.read(np.arange(len(reader)))
+
+    paths = sorted(glob.glob(os.path.join(str(video_path), '*.jpg')), key=frame_number)
+    return len(paths), lambda size, num_threads: read_video(paths, size, num_threads)
+
+def load_clips(buf, meta, clips, sources, lengths, img_size, num_threads):
+    frames, offsets, labels = shared_memory_views(buf, meta)
+    offsets[0] = 0
+    offsets[1:] = np.cumsum(lengths)
+    labels[:] = [label for _, label in clips]
+
+    frame_shape = tuple(meta['frame_shape'])
+    for i, (_, decode) in enumerate(tqdm(sources)):
+        video = decode(img_size, num_threads)
+        if video.shape[1:] != frame_shape:
+            raise ValueError('frame shape of {} differs: {} != {}'.format(
+                clips[i][0], video.shape[1:], frame_shape))
+        frames[offsets[i]:offsets[i+1]] = video
+
+def main():
+    parser = argparse.ArgumentParser(description='Shared memory dataset host')
+    parser.add_argument('dataset_type', choices=['mug', 'mnist'])
+    parser.add_argument('dataset', help='dataset root path')
+    parser.add_argument('--name', default='mocogan_dataset', help='name of the shared memory segment')
+    parser.add_argument('--video_length', type=int, default=16, help='shorter clips are discarded')
+    parser.add_argument('--img_size', type=int, default=None, help='resize frames of jpeg clips')
+    parser.add_argument('--threads', type=int, default=4, help='num decode threads per clip')
+    args = parser.parse_args()
+
+    from multiprocessing import shared_memory
+
+    if args.dataset_type == 'mug':
+        dataset = MugDataset(args.dataset, args.video_length, args.img_size)
+        clips = dataset.videos
+        num_labels = dataset.num_labels
+    else:
+        dataset = MovingMnistDataset(args.dataset, args.video_length, args.img_size)
+        clips = [(path, -1) for path in dataset.videos]
+        num_labels = 0
+    if len(clips) == 0:
+        raise ValueError('no clips found in {}'.format(args.dataset))
+
+    # count frames first, so that clips are decoded directly into the segment
+    sources = [clip_frames(path) for path, _ in clips]
+    first = sources[0][1](args.img_size, 1)[0]
+    lengths = np.array([n for n, _ in sources], dtype=np.int64)
+    num_frames = int(lengths.sum())
+    layout = shared_memory_layout(len(clips), num_frames, first.shape)
+
+    meta = {
+        'num_videos':    len(clips),
+        'num_frames':    num_frames,
+        'frame_shape':   first.shape,
+        'num_labels':    num_labels,
+        'extract_speed': getattr(dataset, 'extract_speed', 1),
+        'manifest':      hashlib.sha1(dataset_manifest(dataset).encode()).hexdigest(),
+        'layout':        layout,
+    }
+
+    shm = shared_memory.SharedMemory(name=args.name, create=True, size=layout['size'])
+    try:
+        print('>>> decoding {} clips ({} frames of {}, {:.1f} MiB) into "{}"...'.format(
+            len(clips), num_frames, 'x'.join(map(str, first.shape)), layout['size'] / 2.**20, args.name))
+        load_clips(shm.buf, meta, clips, sources, lengths, args.img_size, args.threads)
+
+        # the header is written last, jobs can only attach to a complete dataset
+        write_shared_header(shm.buf, meta)
+
+        print('>>> serving, train with: --dataset_type shm --dataset {}'.format(args.name))
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        while True:
+            signal.pause()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        try:
+            shm.close()
+        except BufferError: # views still referenced by a traceback
+            pass
+        shm.unlink()
+        print('>>> removed "{}"'.format(args.name))
+
+if __name__=="__main__":
+    main()
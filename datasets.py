@@ -1,5 +1,12 @@
 import sys, os, glob
+import io
+import json
 import re
+import tarfile
+import traceback
+import multiprocessing
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import chainer
@@ -7,30 +14,103 @@ import numpy as np
 from PIL import Image
 from tqdm import tqdm
 
+from clipfile import ClipReader
+
 frame_name_regex = re.compile(r'([0-9]+).jpg')
 
 def frame_number(name):
     match = re.search(frame_name_regex, str(name))
     return match.group(1)
 
-def read_video(paths):
-    video = []
-    for path in paths:
-        f = Image.open(path)
-        try:
-            frame = np.asarray(f, dtype=np.float32)
-            video.append(frame)
-        finally:
-            if hasattr(f, 'close'):
-                f.close()
+_decode_pool = None, None
+
+def decode_pool(num_threads=4):
+    """
+    return the thread pool shared by read_video (PIL releases the GIL while decoding),
+    a new pool is made in each (forked) process
+    """
+    global _decode_pool
+    pid, pool = _decode_pool
+    if pid != os.getpid():
+        pool = ThreadPoolExecutor(num_threads)
+        _decode_pool = os.getpid(), pool
+    return pool
+
+def read_frame(path, size=None, out=None):
+    """
+    Decode a frame as uint8 (H, W, C).
+    JPEGs larger than size are decoded at reduced size (draft mode), and
+    non-square frames are center cropped before resizing to size x size.
+    """
+    f = Image.open(path)
+    try:
+        if size is not None and (f.width > size or f.height > size):
+            # draft keeps the aspect ratio and both sides >= size
+            f.draft('RGB', (size, size))
+        img = f if f.mode == 'RGB' else f.convert('RGB')
+        if size is not None and img.size != (size, size):
+            w, h = img.size
+            if w != h:
+                s = min(w, h)
+                left, top = (w - s) // 2, (h - s) // 2
+                img = img.crop((left, top, left + s, top + s))
+            if img.size != (size, size):
+                img = img.resize((size, size), Image.BILINEAR)
+        frame = np.asarray(img, dtype=np.uint8)
+    finally:
+        if hasattr(f, 'close'):
+            f.close()
+
+    if out is None:
+        return frame
+    out[...] = frame
+
+def read_video(paths, size=None, num_threads=4):
+    """
+    Decode the frames of a clip on a thread pool into one preallocated buffer
+
+    :param list paths: frame paths
+    :param int size: decode frames at size x size if given
+    :return: video (dim=4, dtype=np.uint8, axis=(video_len, height, width, channel))
+    """
+    first = read_frame(paths[0], size)
+    video = np.empty((len(paths),) + first.shape, dtype=np.uint8)
+    video[0] = first
 
-    return np.asarray(video, dtype=np.float32)
+    if num_threads > 1 and len(paths) > 2:
+        futures = [decode_pool(num_threads).submit(read_frame, path, size, video[i])
+                   for i, path in enumerate(paths[1:], 1)]
+        for future in futures:
+            future.result()
+    else:
+        for i, path in enumerate(paths[1:], 1):
+            read_frame(path, size, video[i])
+
+    return video
+
+def sample_subsequence(video_len, video_length, extract_speed=1, random_state=np.random):
+    """
+    Return frame indices of a random sub-sequence of video_length frames.
+    Long videos are sampled every extract_speed frames.
+    """
+    if video_len < video_length:
+        raise ValueError('invalid video length: {} < {}'.format(video_len, video_length))
+    elif video_len > video_length * extract_speed:
+        needed = extract_speed * (video_length - 1)
+        gap = video_len - needed
+        start = 0 if gap == 0 else random_state.randint(0, gap, 1)[0]
+        return np.linspace(start, start + needed, video_length, endpoint=True, dtype=np.int32)
+    else:
+        gap = video_len - video_length
+        start = 0 if gap == 0 else random_state.randint(0, gap, 1)[0]
+        return np.arange(start, start+video_length)
 
 class MugDataset(chainer.dataset.DatasetMixin):
     # {{{
-    def __init__(self, root_path, video_length=16):
+    def __init__(self, root_path, video_length=16, img_size=None):
         self.root_path = Path(root_path)
         self.video_length = video_length
+        self.img_size = img_size
         self.extract_speed = 2
 
         self.video_categories = list(self.root_path.glob("*"))
@@ -52,10 +132,13 @@ class MugDataset(chainer.dataset.DatasetMixin):
 
             num_categ = category2num[category_path.name]
             for video_path in category_path.glob("*"):
-                if not video_path.is_dir():
+                if video_path.suffix == '.clip':
+                    video_len = len(ClipReader(video_path))
+                elif video_path.is_dir():
+                    video_len = len(list(video_path.glob("*.jpg")))
+                else:
                     continue
                 
-                video_len = len(list(video_path.glob("*.jpg")))
                 if video_len >= video_length:
                     self.videos.append((video_path, num_categ))
                 else:
@@ -69,30 +152,21 @@ class MugDataset(chainer.dataset.DatasetMixin):
         """return video shape: (ch, frame, width, height)"""
         video_path, categ = self.videos[i]
 
-        frame_paths = np.array(sorted(glob.glob(os.path.join(video_path, '*.jpg')), key=frame_number))
-
-        # videos can be of various length, we randomly sample sub-sequences
-        video_len = len(frame_paths)
-        if video_len < self.video_length:
-            raise ValueError('invalid video length: {} < {}'
-                .format(len(frame_paths), self.video_length))
-        elif video_len > self.video_length * self.extract_speed:
-            needed = self.extract_speed * (self.video_length - 1)
-            gap = video_len - needed
-            start = 0 if gap == 0 else np.random.randint(0, gap, 1)[0]
-            subsequence_idx = np.linspace(start, start + needed, self.video_length, endpoint=True, dtype=np.int32)
-            frame_paths = frame_paths[subsequence_idx]
+        if video_path.suffix == '.clip':
+            # .clip file, only the groups holding the sampled frames are decoded
+            reader = ClipReader(video_path)
+            video = reader.read(sample_subsequence(len(reader), self.video_length, self.extract_speed))
         else:
-            gap = video_len - self.video_length
-            start = 0 if gap == 0 else np.random.randint(0, gap, 1)[0]
-            subsequence_idx = np.arange(start, start+self.video_length)
-            frame_paths = frame_paths[subsequence_idx]
-    
-        # read video
-        video = read_video(frame_paths)
+            frame_paths = np.array(sorted(glob.glob(os.path.join(video_path, '*.jpg')), key=frame_number))
+
+            # videos can be of various length, we randomly sample sub-sequences
+            frame_paths = frame_paths[sample_subsequence(len(frame_paths), self.video_length, self.extract_speed)]
+        
+            # read video
+            video = read_video(frame_paths, self.img_size)
         if len(video.shape) != 4:
             raise ValueError('invalid video shape: {}'.format(video.shape))
-        video = (video - 128.) / 128.
+        video = (video.astype(np.float32) - 128.) / 128.
         
         # # concat label data as feature maps
         # t, y, x, c = video.shape
@@ -109,8 +183,9 @@ class MugDataset(chainer.dataset.DatasetMixin):
 
 class MovingMnistDataset(chainer.dataset.DatasetMixin):
     # {{{
-    def __init__(self, dataset_path, video_length=16):
+    def __init__(self, dataset_path, video_length=16, img_size=None):
         self.video_length = video_length
+        self.img_size = img_size
         
         save_path = Path("data/dataset/moving_mnist/preprocessed")
         if not save_path.exists():
@@ -145,23 +220,317 @@ class MovingMnistDataset(chainer.dataset.DatasetMixin):
         frame_paths = np.array(frame_paths)
 
         # videos can be of various length, we randomly sample sub-sequences
-        video_len = len(frame_paths)
-        if video_len < self.video_length:
+        if len(frame_paths) < self.video_length:
             raise ValueError('invalid video length: {} < {} ({})'
                 .format(len(frame_paths), self.video_length, video_path))
-        else:
-            gap = video_len - self.video_length
-            start = 0 if gap == 0 else np.random.randint(0, gap, 1)[0]
-            subsequence_idx = np.arange(start, start+self.video_length)
-            frame_paths = frame_paths[subsequence_idx]
+        frame_paths = frame_paths[sample_subsequence(len(frame_paths), self.video_length)]
 
         # read video
-        video = read_video(frame_paths)
+        video = read_video(frame_paths, self.img_size)
         if len(video.shape) != 4:
             raise ValueError('invalid video shape: {}'.format(video.shape))
-        video = (video - 128.) / 128.
-        video = video.astype(np.float32)
+        video = (video.astype(np.float32) - 128.) / 128.
         video = video.transpose(3, 0, 1, 2) # (C, T, H, W)
         
         return video, None
     # }}}
+
+def decode_jpeg(data):
+    f = Image.open(io.BytesIO(data))
+    try:
+        return np.asarray(f.convert('RGB'), dtype=np.uint8)
+    finally:
+        f.close()
+
+class ShardDataset(object):
+    # {{{
+    """
+    Clips stored in sequential tar shards written by `preprocess.py --format shards`.
+    Shards are only read sequentially; use ShardIterator for training.
+    """
+    def __init__(self, root_path, video_length=16, shuffle_buffer=1000):
+        self.root_path = Path(root_path)
+        self.video_length = video_length
+        self.shuffle_buffer = shuffle_buffer
+        self.extract_speed = 2
+
+        with open(str(self.root_path / 'manifest.json')) as f:
+            self.info = json.load(f)
+        self.shards = [self.root_path / s['name'] for s in self.info['shards']]
+        self.num_labels = self.info.get('num_labels', 0)
+        self.num_videos = sum(s['num'] for s in self.info['shards'])
+
+    def __len__(self):
+        return self.num_videos
+
+    def manifest(self):
+        return json.dumps({'video_length': self.video_length, 'shards': self.info['shards']})
+
+    def read_shard(self, path):
+        """ yield (list of jpeg bytes, label) of each clip in order """
+        key, frames, label = None, {}, None
+        # 'r|' reads the tar as a stream without any seek
+        with tarfile.open(str(path), 'r|') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                name, ext = member.name.split('.', 1)
+                if name != key:
+                    if key is not None:
+                        yield [frames[k] for k in sorted(frames)], label
+                    key, frames, label = name, {}, None
+                data = tar.extractfile(member).read()
+                if ext == 'cls':
+                    label = int(data)
+                else:
+                    frames[ext] = data
+        if key is not None:
+            yield [frames[k] for k in sorted(frames)], label
+
+    def iter_raw(self, shards, random_state=np.random, shuffle=True):
+        """
+        yield (uint8 video (T, H, W, C), label) from the given shards,
+        shuffled through a buffer of shuffle_buffer encoded clips
+        """
+        buf = []
+        for path in shards:
+            for clip in self.read_shard(path):
+                if not shuffle:
+                    yield self.decode(clip, random_state)
+                elif len(buf) < self.shuffle_buffer:
+                    buf.append(clip)
+                else:
+                    i = random_state.randint(len(buf))
+                    yield self.decode(buf[i], random_state)
+                    buf[i] = clip
+
+        random_state.shuffle(buf)
+        for clip in buf:
+            yield self.decode(clip, random_state)
+
+    def decode(self, clip, random_state=np.random):
+        jpegs, label = clip
+        idx = sample_subsequence(len(jpegs), self.video_length, self.extract_speed, random_state)
+        video = np.stack(list(decode_pool().map(decode_jpeg, [jpegs[i] for i in idx])))
+
+        return video, label
+
+    def to_example(self, video, label):
+        video = (video.astype(np.float32) - 128.) / 128.
+        video = video.transpose(3, 0, 1, 2) # (C, T, H, W)
+
+        return video, label
+
+    def __iter__(self):
+        """ one sequential pass without shuffling """
+        for video, label in self.iter_raw(self.shards, shuffle=False):
+            yield self.to_example(video, label)
+    # }}}
+
+class ShardWorkerError(object):
+    """ sent by a loader process in place of an example when it fails """
+    def __init__(self, worker_id, message):
+        self.worker_id = worker_id
+        self.message = message
+
+def _shard_worker(dataset, worker_id, num_workers, seed, examples):
+    epoch = 0
+    try:
+        while True:
+            # every worker uses the same shard permutation and takes its own part
+            order = np.random.RandomState(seed + epoch).permutation(len(dataset.shards))
+            shards = [dataset.shards[i] for i in order[worker_id::num_workers]]
+            random_state = np.random.RandomState(seed + epoch * num_workers + worker_id + 1)
+            for example in dataset.iter_raw(shards, random_state):
+                examples.put(example)
+            epoch += 1
+    except Exception:
+        examples.put(ShardWorkerError(worker_id, traceback.format_exc()))
+        raise
+
+class ShardIterator(chainer.dataset.Iterator):
+    """
+    Iterator over a ShardDataset. Shards are split across n_processes loader
+    processes which read them sequentially; epochs are counted in examples,
+    so examples of adjacent epochs can mix at the epoch boundary.
+    """
+    def __init__(self, dataset, batch_size, n_processes=2, seed=0, n_prefetch=4, timeout=5.):
+        """
+        :param float timeout: seconds to wait for an example before checking
+            that the loader processes are still alive
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.n_processes = n_processes
+        self.seed = seed
+        self.timeout = timeout
+
+        self.epoch = 0
+        self.current_position = 0
+        self.is_new_epoch = False
+
+        if n_processes > 0:
+            self.queue = multiprocessing.Queue(n_prefetch * batch_size)
+            self.workers = [multiprocessing.Process(target=_shard_worker,
+                                                    args=(dataset, i, n_processes, seed, self.queue),
+                                                    daemon=True)
+                            for i in range(n_processes)]
+            for w in self.workers:
+                w.start()
+            self.stream = self.worker_stream()
+        else:
+            self.workers = []
+            self.stream = self.local_stream()
+
+    def check_workers(self):
+        for i, w in enumerate(self.workers):
+            if not w.is_alive():
+                raise RuntimeError('shard loader process {} exited with code {}'.format(i, w.exitcode))
+
+    def worker_stream(self):
+        while True:
+            try:
+                example = self.queue.get(timeout=self.timeout)
+            except queue.Empty:
+                self.check_workers()
+                continue
+            if isinstance(example, ShardWorkerError):
+                raise RuntimeError('shard loader process {} failed:\n{}'.format(
+                    example.worker_id, example.message))
+            yield example
+
+    def local_stream(self):
+        epoch = 0
+        while True:
+            random_state = np.random.RandomState(self.seed + epoch)
+            shards = [self.dataset.shards[i] for i in random_state.permutation(len(self.dataset.shards))]
+            for example in self.dataset.iter_raw(shards, random_state):
+                yield example
+            epoch += 1
+
+    def __next__(self):
+        # a dead loader would silently drop its shards while the others keep the queue filled
+        self.check_workers()
+        batch = [self.dataset.to_example(*next(self.stream)) for _ in range(self.batch_size)]
+
+        self.current_position += self.batch_size
+        if self.current_position >= len(self.dataset):
+            self.current_position -= len(self.dataset)
+            self.epoch += 1
+            self.is_new_epoch = True
+        else:
+            self.is_new_epoch = False
+
+        return batch
+
+    next = __next__
+
+    @property
+    def epoch_detail(self):
+        return self.epoch + self.current_position / len(self.dataset)
+
+    def serialize(self, serializer):
+        self.current_position = serializer('current_position', self.current_position)
+        self.epoch = serializer('epoch', self.epoch)
+        self.is_new_epoch = serializer('is_new_epoch', self.is_new_epoch)
+
+    def finalize(self):
+        for w in self.workers:
+            w.terminate()
+        self.workers = []
+
+SHM_HEADER_SIZE = 4096
+
+def shared_memory_layout(num_videos, num_frames, frame_shape):
+    """
+    Byte layout of a shared memory dataset (see dataset_host.py):
+    a JSON header, all frames as uint8 (num_frames, H, W, C), the frame
+    offset of each video (num_videos+1, int64) and the labels (num_videos, int64, -1: none)
+    """
+    def align(n):
+        return (n + 63) // 64 * 64
+
+    frames = SHM_HEADER_SIZE
+    offsets = frames + align(num_frames * int(np.prod(frame_shape)))
+    labels = offsets + align(8 * (num_videos + 1))
+
+    return {'frames': frames, 'offsets': offsets, 'labels': labels, 'size': labels + 8 * num_videos}
+
+def write_shared_header(buf, meta):
+    data = json.dumps(meta).encode()
+    if 8 + len(data) > SHM_HEADER_SIZE:
+        raise ValueError('shared memory header too large: {} bytes'.format(len(data)))
+    buf[:8] = np.uint64(len(data)).tobytes()
+    buf[8:8+len(data)] = data
+
+def read_shared_header(buf):
+    size = int(np.frombuffer(buf, np.uint64, 1)[0])
+    if size == 0:
+        raise ValueError('shared memory dataset is still loading')
+    return json.loads(bytes(buf[8:8+size]).decode())
+
+def shared_memory_views(buf, meta):
+    """ return numpy views (frames, offsets, labels) of a shared memory dataset """
+    layout = meta['layout']
+    frames = np.ndarray((meta['num_frames'],) + tuple(meta['frame_shape']), np.uint8, buf, layout['frames'])
+    offsets = np.ndarray((meta['num_videos'] + 1,), np.int64, buf, layout['offsets'])
+    labels = np.ndarray((meta['num_videos'],), np.int64, buf, layout['labels'])
+
+    return frames, offsets, labels
+
+def attach_shared_memory(name):
+    """
+    Attach to an existing shared memory segment without owning it: the
+    resource tracker would otherwise unlink it when this process exits.
+    """
+    from multiprocessing import shared_memory, resource_tracker
+
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError: # python < 3.13
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+class SharedMemoryDataset(chainer.dataset.DatasetMixin):
+    # {{{
+    """
+    Dataset served from shared memory by dataset_host.py. Frames are read
+    through read-only views of the segment, so any number of training
+    processes share one decoded copy of the dataset.
+    """
+    def __init__(self, name, video_length=16):
+        self.name = name
+        self.video_length = video_length
+
+        self.shm = attach_shared_memory(name)
+        self.meta = read_shared_header(self.shm.buf)
+        self.frames, self.offsets, self.labels = shared_memory_views(self.shm.buf, self.meta)
+        for a in (self.frames, self.offsets, self.labels):
+            a.flags.writeable = False
+
+        self.num_labels = self.meta['num_labels']
+        self.extract_speed = self.meta['extract_speed']
+
+    def __reduce__(self):
+        # attach again instead of pickling the frames
+        return self.__class__, (self.name, self.video_length)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def manifest(self):
+        return json.dumps({'video_length': self.video_length, 'shared': self.meta['manifest']})
+
+    def get_example(self, i):
+        """return video shape: (ch, frame, width, height)"""
+        start, end = self.offsets[i], self.offsets[i+1]
+        index = sample_subsequence(end - start, self.video_length, self.extract_speed)
+        video = self.frames[start + index]
+
+        video = (video.astype(np.float32) - 128.) / 128.
+        video = video.transpose(3, 0, 1, 2) # (C, T, H, W)
+        label = int(self.labels[i])
+
+        return video, (label if label >= 0 else None)
+    # }}}
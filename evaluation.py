@@ -0,0 +1,235 @@
+"""
+Frechet distance (FID / FVD style) evaluation of generated videos
+
+Features are the globally pooled dc4 activations of a fixed discriminator:
+an ImageDiscriminator applied to every frame (FID) and a VideoDiscriminator
+applied to whole clips (FVD). Pass trained discriminator weights to get
+meaningful features; by default randomly initialized networks with a fixed
+seed are used, with batch normalization reset to the identity (zero mean,
+unit variance) since they have no running statistics.
+
+Feature statistics are accumulated batch by batch, so no features are
+kept in memory, and the statistics of the real data are cached on disk
+keyed by the dataset manifest and the extractor weights.
+"""
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+from scipy import linalg
+
+import chainer
+import chainer.functions as F
+from chainer.dataset import concat_examples
+
+from model.net import ImageDiscriminator, VideoDiscriminator
+
+class RunningStatistics(object):
+    """ Mean and covariance updated batch by batch (Chan et al.) """
+    def __init__(self, dim):
+        self.n = 0
+        self.mean = np.zeros(dim, dtype=np.float64)
+        self.m2 = np.zeros((dim, dim), dtype=np.float64)
+
+    def update(self, x):
+        """
+        :param np.ndarray x: features, shape: (batchsize, dim)
+        """
+        x = np.asarray(x, dtype=np.float64)
+        n_b = len(x)
+        if n_b == 0:
+            return
+        mean_b = x.mean(axis=0)
+        d = x - mean_b
+        m2_b = d.T.dot(d)
+
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.mean += delta * (n_b / n)
+        self.m2 += m2_b + np.outer(delta, delta) * (self.n * n_b / n)
+        self.n = n
+
+    @property
+    def cov(self):
+        return self.m2 / max(self.n - 1, 1)
+
+def frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
+    diff = mu1 - mu2
+    covmean, _ = linalg.sqrtm(sigma1.dot(sigma2), disp=False)
+    if not np.isfinite(covmean).all():
+        offset = np.eye(sigma1.shape[0]) * eps
+        covmean = linalg.sqrtm((sigma1 + offset).dot(sigma2 + offset))
+    covmean = np.real(covmean)
+
+    return float(diff.dot(diff) + np.trace(sigma1) + np.trace(sigma2) - 2 * np.trace(covmean))
+
+def dataset_manifest(dataset):
+    """ return a string identifying the contents of the dataset """
+    if hasattr(dataset, 'manifest'):
+        return dataset.manifest()
+
+    videos = sorted(str(v[0] if isinstance(v, tuple) else v) for v in dataset.videos)
+    return json.dumps({'video_length': dataset.video_length, 'videos': videos})
+
+class FeatureExtractor(object):
+    def __init__(self, in_channels=3, image_dis_path='', video_dis_path='', seed=0):
+        state = np.random.get_state()
+        np.random.seed(seed)
+        self.image_dis = ImageDiscriminator(in_channels)
+        self.video_dis = VideoDiscriminator(in_channels)
+        np.random.set_state(state)
+
+        for net, path in ((self.image_dis, image_dis_path), (self.video_dis, video_dis_path)):
+            if path:
+                chainer.serializers.load_npz(path, net)
+            else:
+                # without trained statistics test-mode batch normalization
+                # divides by sqrt(avg_var + eps), and avg_var starts at zero
+                for bn in (net.bn2, net.bn3, net.bn4):
+                    bn.avg_mean.fill(0)
+                    bn.avg_var.fill(1)
+
+    def to_gpu(self):
+        self.image_dis.to_gpu()
+        self.video_dis.to_gpu()
+
+    def key(self):
+        """ return a digest of the extractor weights and batch normalization statistics """
+        h = hashlib.sha1()
+        for net in (self.image_dis, self.video_dis):
+            s = chainer.serializers.DictionarySerializer()
+            s.save(net)
+            for name, value in sorted(s.target.items()):
+                h.update(name.encode('utf-8'))
+                h.update(np.asarray(value).tobytes())
+        return h.hexdigest()
+
+    def pooled(self, net, x):
+        y = F.leaky_relu(net.dc1(x), slope=0.2)
+        y = F.leaky_relu(net.bn2(net.dc2(y)), slope=0.2)
+        y = F.leaky_relu(net.bn3(net.dc3(y)), slope=0.2)
+        y = F.leaky_relu(net.bn4(net.dc4(y)), slope=0.2)
+        y = chainer.cuda.to_cpu(y.data)
+
+        return y.reshape(y.shape[0], y.shape[1], -1).mean(axis=2)
+
+    def __call__(self, videos):
+        """
+        :param videos: videos, shape: (batchsize, channel, video_length, height, width)
+        :return: frame features (batchsize*video_length, dim), video features (batchsize, dim)
+        """
+        N, C, T, H, W = videos.shape
+        with chainer.using_config('train', False), chainer.no_backprop_mode():
+            frames = videos.transpose(0, 2, 1, 3, 4).reshape(N*T, C, H, W)
+            return self.pooled(self.image_dis, frames), self.pooled(self.video_dis, videos)
+
+class FrechetEvaluator(object):
+    def __init__(self, extractor, dataset, batchsize=64, cache_dir='data/fid_cache', device=-1):
+        self.extractor = extractor
+        self.dataset = dataset
+        self.batchsize = batchsize
+        self.cache_dir = Path(cache_dir)
+        self.device = device
+        self._real = None
+
+    def new_statistics(self):
+        return (RunningStatistics(self.extractor.image_dis.n_filters*8),
+                RunningStatistics(self.extractor.video_dis.n_filters*8))
+
+    def real_batches(self):
+        if hasattr(self.dataset, '__getitem__'):
+            examples = (self.dataset[i] for i in range(len(self.dataset)))
+        else:
+            # streaming datasets are read sequentially
+            examples = iter(self.dataset)
+
+        batch = []
+        for example in examples:
+            batch.append(example)
+            if len(batch) == self.batchsize:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def real_statistics(self):
+        if self._real is not None:
+            return self._real
+
+        key = hashlib.sha1((dataset_manifest(self.dataset) + self.extractor.key())
+                           .encode('utf-8')).hexdigest()
+        cache_path = self.cache_dir / '{}.npz'.format(key)
+        if cache_path.exists():
+            s = np.load(str(cache_path))
+            self._real = ((s['image_mean'], s['image_cov']),
+                          (s['video_mean'], s['video_cov']))
+            return self._real
+
+        image_stats, video_stats = self.new_statistics()
+        for batch in self.real_batches():
+            x, _ = concat_examples(batch, self.device)
+            f_image, f_video = self.extractor(x)
+            image_stats.update(f_image)
+            video_stats.update(f_video)
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        np.savez(str(cache_path),
+                 image_mean=image_stats.mean, image_cov=image_stats.cov,
+                 video_mean=video_stats.mean, video_cov=video_stats.cov)
+        self._real = ((image_stats.mean, image_stats.cov),
+                      (video_stats.mean, video_stats.cov))
+
+        return self._real
+
+    def match_real(self, videos, xp, img_size=64):
+        """
+        Nearest neighbor resize of generated videos to the real clip length and
+        resolution, for videos generated during progressive training
+        """
+        N, C, T, H, W = videos.shape
+        if T < self.dataset.video_length:
+            idx = np.linspace(0, T - 1, self.dataset.video_length).round().astype(np.int32)
+            videos = videos[:, :, idx]
+        if H < img_size:
+            f = img_size // H
+            videos = xp.repeat(xp.repeat(videos, f, axis=3), f, axis=4)
+
+        return videos
+
+    def evaluate(self, image_gen, num, xp=np):
+        """
+        :return: FID of frames and FVD of videos for num generated videos
+        """
+        real_image, real_video = self.real_statistics()
+
+        image_stats, video_stats = self.new_statistics()
+        with chainer.using_config('train', False), chainer.no_backprop_mode():
+            for i in range(0, num, self.batchsize):
+                videos, _ = image_gen(min(self.batchsize, num - i), xp)
+                videos = videos.data.transpose(1, 2, 0, 3, 4) # (T, N, C, H, W) -> (N, C, T, H, W)
+                videos = self.match_real(videos, xp)
+                f_image, f_video = self.extractor(videos)
+                image_stats.update(f_image)
+                video_stats.update(f_video)
+
+        fid = frechet_distance(image_stats.mean, image_stats.cov, *real_image)
+        fvd = frechet_distance(video_stats.mean, video_stats.cov, *real_video)
+
+        return fid, fvd
+
+def frechet_evaluation(evaluator, image_gen, num, writer=None):
+    # run before LogReport (PRIORITY_WRITER), like chainer's Evaluator, so that
+    # fid and fvd are reported in the same iteration
+    @chainer.training.make_extension(priority=chainer.training.PRIORITY_WRITER)
+    def evaluate(trainer):
+        updater = trainer.updater
+        xp = np if updater.device == -1 else chainer.cuda.cupy
+
+        fid, fvd = evaluator.evaluate(image_gen, num, xp)
+        chainer.report({'fid': fid, 'fvd': fvd})
+        if writer is not None:
+            writer.add_scalar('fid', fid, updater.epoch)
+            writer.add_scalar('fvd', fvd, updater.epoch)
+
+    return evaluate
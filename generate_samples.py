@@ -12,7 +12,10 @@ from chainer import Variable
 import chainer.functions as F
 
 from model.net import ImageGenerator
-from util import to_grid, save_frames, save_video
+from model.quantize import Int8WeightImageGenerator
+from model.decompose import ContentMotionSampler
+from model.backend import BACKENDS, use_backend, select_kernels
+from util import to_grid, save_frames, save_video, VideoWriter
 
 def main():
     parser = argparse.ArgumentParser()
@@ -20,6 +23,13 @@ def main():
     parser.add_argument('save_path')
     parser.add_argument('--num', '-n', type=int, default=36)
     parser.add_argument('--gpu', '-g', type=int, default=-1)
+    parser.add_argument('--backend', choices=BACKENDS, default='numpy', help='CPU backend (ideep: falls back per layer)')
+    parser.add_argument('--int8_weights', default='',
+                        help='generator weights stored as int8 by quantize.py (cpu only, not faster than float32)')
+    parser.add_argument('--swap', action='store_true', help='rows share the content, columns share the motion')
+    parser.add_argument('--length', '-l', type=int, default=0,
+                        help='stream a video of this many frames (only the grid video is saved)')
+    parser.add_argument('--chunk', type=int, default=16, help='num frames generated at once when streaming')
     args = parser.parse_args()
     
     # check num
@@ -32,10 +42,40 @@ def main():
     
     gen = ImageGenerator()
     serializers.load_npz(args.model_weight, gen)
+    if args.gpu == -1:
+        select_kernels(gen, use_backend(args.backend))
+
+    if args.length > 0:
+        print(">>> generating and saving {} frames...".format(args.length))
+        save_path = Path(args.save_path)
+        save_path.mkdir(parents=True, exist_ok=True)
+
+        writer = None
+        for videos in gen.stream(args.num, args.length, xp, args.chunk):
+            videos = chainer.cuda.to_cpu(videos) # (chunk, bs, c, w, h)
+            videos = ((videos / 2. + 0.5) * 255).astype(np.uint8)
+            grid_video = to_grid(videos, n).transpose(0, 2, 3, 1)
+            if writer is None:
+                writer = VideoWriter(save_path/'grid.mp4', *grid_video.shape[1:3])
+            writer.write(grid_video)
+        writer.close()
+        return
 
     print(">>> generating...")
-    videos = gen(args.num, xp) # (t, bs, c, w, h)
-    videos = videos[0].data
+    if args.swap:
+        sampler = ContentMotionSampler(gen, xp)
+        videos = sampler.grid(sampler.make_contents(n), sampler.make_motions(n)) # (t, n, n, c, w, h)
+        videos = chainer.cuda.to_cpu(videos)
+        videos = videos.reshape((videos.shape[0], args.num) + videos.shape[3:])
+    elif args.int8_weights:
+        qgen = Int8WeightImageGenerator.load_npz(args.int8_weights)
+        with chainer.using_config('train', False), chainer.no_backprop_mode():
+            z, _ = gen.make_z(args.num, np)
+        videos = qgen.render(z)
+        videos = videos.reshape((gen.video_len, args.num) + videos.shape[1:]) # (t, bs, c, w, h)
+    else:
+        videos = gen(args.num, xp) # (t, bs, c, w, h)
+        videos = chainer.cuda.to_cpu(videos[0].data)
     videos = ((videos / 2. + 0.5) * 255).astype(np.uint8)
     
     print(">>> saving...")
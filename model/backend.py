@@ -0,0 +1,107 @@
+"""
+CPU backend selection with per layer kernel fallback
+
+With the 'ideep' backend (iDeep / oneDNN, chainer >= 4 with ideep4py),
+2D (de)convolutions written as N-dimensional links are replaced by their
+2D links, which have iDeep kernels, and the parameters of every layer
+with an iDeep kernel are converted to iDeep arrays once, so that layout
+conversion stays outside the training loop. 3D convolutions with a
+temporal stride of 1 run as one 2D convolution per temporal kernel
+offset (see net.convolution_3d_by_2d). Layers without an iDeep kernel
+(batch normalizations of 5D inputs, weights that are sliced in the
+forward pass) keep numpy arrays and run on the default path.
+"""
+import warnings
+
+import chainer
+import chainer.links as L
+from chainer.utils import conv_nd
+
+BACKENDS = ('numpy', 'ideep')
+
+def ideep_available():
+    try:
+        from chainer.backends import intel64
+    except ImportError:
+        return False
+    return intel64.is_ideep_available()
+
+def use_backend(backend):
+    """
+    Enable a backend globally and return the backend actually used
+    """
+    if backend == 'ideep' and not ideep_available():
+        warnings.warn('iDeep is not available (requires chainer>=4 and ideep4py), '
+                      'falling back to numpy')
+        backend = 'numpy'
+
+    if backend == 'ideep':
+        chainer.global_config.use_ideep = 'auto'
+    elif hasattr(chainer.global_config, 'use_ideep'):
+        chainer.global_config.use_ideep = 'never'
+
+    return backend
+
+def to_2d_link(link):
+    """ return a 2D link equivalent to a 2D ConvolutionND/DeconvolutionND, or None """
+    if link.W.ndim != 4:
+        return None
+
+    b = None if link.b is None else link.b.data
+    if isinstance(link, L.DeconvolutionND):
+        in_channels, out_channels = link.W.shape[:2]
+        return L.Deconvolution2D(in_channels, out_channels, link.W.shape[2:],
+                                 stride=link.stride, pad=link.pad, nobias=b is None,
+                                 initialW=link.W.data, initial_bias=b)
+    if isinstance(link, L.ConvolutionND):
+        out_channels, in_channels = link.W.shape[:2]
+        return L.Convolution2D(in_channels, out_channels, link.W.shape[2:],
+                               stride=link.stride, pad=link.pad, nobias=b is None,
+                               initialW=link.W.data, initial_bias=b)
+    return None
+
+def select_kernels(chain, backend):
+    """
+    Prepare the direct children of chain for a backend. Call before setting up
+    optimizers, as links may be replaced.
+
+    :return: list of (layer name, kernel) describing the selection
+    """
+    report = []
+    if backend != 'ideep':
+        for name in sorted(l.name for l in chain.children()):
+            report.append((name, 'numpy'))
+        return report
+
+    sliced = getattr(chain, 'sliced_links', ())
+    has_3d = any(getattr(getattr(l, 'W', None), 'ndim', 0) == 5 for l in chain.children())
+
+    for link in sorted(chain.children(), key=lambda l: l.name):
+        name = link.name
+        if name in sliced:
+            report.append((name, 'numpy (weights sliced in forward)'))
+            continue
+
+        if isinstance(link, (L.ConvolutionND, L.DeconvolutionND)):
+            new = to_2d_link(link)
+            if new is None and link.W.ndim == 5 and hasattr(chain, 'temporal_slices') \
+                    and isinstance(link, L.ConvolutionND) and conv_nd.as_tuple(link.stride, 3)[0] == 1:
+                chain.temporal_slices = True
+                report.append((name, 'ideep (2d per temporal offset)'))
+                continue
+            if new is None:
+                report.append((name, 'numpy ({}d not supported)'.format(link.W.ndim - 2)))
+                continue
+            delattr(chain, name)
+            with chain.init_scope():
+                setattr(chain, name, new)
+            link = new
+
+        if isinstance(link, L.BatchNormalization) and has_3d:
+            report.append((name, 'numpy (5d input not supported)'))
+            continue
+
+        link.to_intel64()
+        report.append((name, 'ideep'))
+
+    return report
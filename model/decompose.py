@@ -0,0 +1,156 @@
+"""
+Content / motion decomposed sampling
+
+The dc1 projection of [zc, zm] is split into a content part, computed
+and cached once per content code, and a motion part, computed once per
+motion trajectory. Any combination of contents and motions is then a sum
+of the two projections followed by ImageGenerator.decode, so content-swap
+and interpolation grids do not recompute dc1 for every frame.
+"""
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import chainer
+from chainer import Variable
+
+class ContentMotionSampler(object):
+    def __init__(self, gen, xp=np, batchsize=256, cache_size=1024):
+        """
+        :param ImageGenerator gen: trained generator
+        :param int batchsize: max num frames decoded at once
+        :param int cache_size: max num cached content projections
+        """
+        self.gen = gen
+        self.xp = xp
+        self.batchsize = batchsize
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def make_contents(self, num):
+        """ return random content codes, shape: (num, dim_zc) """
+        return self.xp.asarray(self.gen.make_hidden(num, self.gen.dim_zc))
+
+    def make_motions(self, num, labels=None):
+        """
+        Return motion trajectories which can be reused across contents
+
+        output shape: (video_length, num, dim_zm)
+        """
+        gen, xp = self.gen, self.xp
+        with chainer.using_config('train', False), chainer.no_backprop_mode():
+            if gen.use_label:
+                if labels is None:
+                    labels = xp.random.randint(gen.dim_zl, size=num)
+                zl = Variable(gen.to_one_hot(xp.asarray(labels), xp))
+            else:
+                zl = None
+            zm = gen.make_zm(num, zl, xp)
+
+        return zm.data
+
+    def content_projection(self, zc):
+        """
+        Return the cached dc1 content projection of each content code
+
+        input zc shape:  (num, dim_zc)
+        output shape: (num, n_filters*8, 4, 4)
+        """
+        zc = self.xp.asarray(zc, dtype=np.float32)
+        keys = [hashlib.sha1(chainer.cuda.to_cpu(z).tobytes()).hexdigest() for z in zc]
+
+        missing = [i for i, k in enumerate(keys) if k not in self.cache]
+        if missing:
+            with chainer.using_config('train', False), chainer.no_backprop_mode():
+                hc = self.gen.project_content(zc[missing]).data
+            for i, h in zip(missing, hc):
+                self.cache[keys[i]] = h
+
+        for k in keys:
+            self.cache.move_to_end(k)
+        hc = self.xp.stack([self.cache[k] for k in keys])
+
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return hc
+
+    def motion_projection(self, zm):
+        """
+        input zm shape:  (video_length, num, dim_zm)
+        output shape: (video_length, num, n_filters*8, 4, 4)
+        """
+        T, M = zm.shape[:2]
+        with chainer.using_config('train', False), chainer.no_backprop_mode():
+            hm = self.gen.project_motion(self.xp.reshape(zm, (T*M, -1))).data
+
+        return hm.reshape((T, M) + hm.shape[1:])
+
+    def decode(self, h):
+        """
+        input h shape:  (..., n_filters*8, 4, 4)
+        output shape: (..., channel, x, y)
+        """
+        lead = h.shape[:-3]
+        h = h.reshape((-1,) + h.shape[-3:])
+
+        xs = []
+        with chainer.using_config('train', False), chainer.no_backprop_mode():
+            for i in range(0, len(h), self.batchsize):
+                xs.append(self.gen.decode(h[i:i+self.batchsize]).data)
+        x = self.xp.concatenate(xs)
+
+        return x.reshape(lead + x.shape[1:])
+
+    def grid(self, zc, zm):
+        """
+        Generate every combination of contents and motions
+
+        input zc shape:  (num_contents, dim_zc)
+        input zm shape:  (video_length, num_motions, dim_zm)
+        output shape: (video_length, num_contents, num_motions, channel, x, y)
+        """
+        hc = self.content_projection(zc)
+        hm = self.motion_projection(zm)
+        h = hc[None, :, None] + hm[:, None, :]
+
+        return self.decode(h)
+
+    def motions_for_content(self, zc, zm):
+        """
+        Generate several motions of a fixed content
+
+        input zc shape:  (dim_zc,)
+        input zm shape:  (video_length, num_motions, dim_zm)
+        output shape: (video_length, num_motions, channel, x, y)
+        """
+        return self.grid(zc[None], zm)[:, 0]
+
+    def contents_for_motion(self, zc, zm):
+        """
+        Generate several contents with a fixed motion
+
+        input zc shape:  (num_contents, dim_zc)
+        input zm shape:  (video_length, dim_zm)
+        output shape: (video_length, num_contents, channel, x, y)
+        """
+        return self.grid(zc, zm[:, None])[:, :, 0]
+
+    def interpolate(self, zc_a, zc_b, steps, zm):
+        """
+        Interpolate between two contents with fixed motions.
+        The projection is linear, so the content codes are interpolated
+        in projection space from the two cached projections.
+
+        input zc_a, zc_b shape:  (dim_zc,)
+        input zm shape:  (video_length, num_motions, dim_zm)
+        output shape: (video_length, steps, num_motions, channel, x, y)
+        """
+        xp = self.xp
+        hc = self.content_projection(xp.stack((zc_a, zc_b)))
+        alpha = xp.linspace(0, 1, steps, dtype=np.float32)[:, None, None, None]
+        hc = (1 - alpha) * hc[0] + alpha * hc[1]
+        hm = self.motion_projection(zm)
+        h = hc[None, :, None] + hm[:, None, :]
+
+        return self.decode(h)
@@ -6,6 +6,7 @@ import chainer
 import chainer.functions as F
 import chainer.links as L
 from chainer import Variable
+from chainer.utils import conv_nd
 
 def add_noise(x, use_noise, sigma):
     xp = chainer.cuda.get_array_module(x.data)
@@ -14,9 +15,41 @@ def add_noise(x, use_noise, sigma):
     else:
         return x
 
+def convolution_3d_by_2d(x, W, b, stride, pad):
+    """
+    3D convolution with temporal stride 1 computed as a sum of 2D
+    convolutions, one per temporal kernel offset, with time folded into the
+    batch, so that it runs on the 2D kernels of an optimized backend.
+
+    input x shape: (batchsize, in_channels, T, H, W)
+    output shape:  (batchsize, out_channels, T', H', W')
+    """
+    if stride[0] != 1:
+        raise ValueError('temporal stride must be 1: {}'.format(stride))
+    if pad[0] > 0:
+        x = F.pad(x, ((0, 0), (0, 0), (pad[0], pad[0]), (0, 0), (0, 0)), 'constant')
+
+    N, C, T, H, W_ = x.shape
+    kt = W.shape[2]
+    T_out = T - kt + 1
+    x = F.transpose(x, (0, 2, 1, 3, 4))
+
+    y = None
+    for k in range(kt):
+        xk = F.reshape(x[:, k:k+T_out], (N*T_out, C, H, W_))
+        yk = F.convolution_2d(xk, W[:, :, k], b if k == 0 else None, stride=stride[1:], pad=pad[1:])
+        y = yk if y is None else y + yk
+
+    y = F.reshape(y, (N, T_out) + y.shape[1:])
+    return F.transpose(y, (0, 2, 1, 3, 4))
+
 class ImageGenerator(chainer.Chain):
     def __init__(self, dim_zc=50, dim_zm=10, dim_zl=0, out_channels=3, \
-                       n_filters=64, video_len=16):
+                       n_filters=64, video_len=16, progressive=False):
+        """
+        :param bool progressive: add a 32x32 output layer for progressive training,
+                                 see img_size and alpha
+        """
         super(ImageGenerator, self).__init__()
         
         self.dim_zc = dim_zc
@@ -25,10 +58,17 @@ class ImageGenerator(chainer.Chain):
         self.out_channels = out_channels
         self.n_filters = n_filters
         self.video_len = video_len
+        self.progressive = progressive
+
+        # output resolution, and weight of the 64x64 output while it fades in
+        self.img_size = 64
+        self.alpha = 1.0
 
         n_hidden = dim_zc + dim_zm
         self.n_hidden = n_hidden
         self.use_label = dim_zl != 0
+        # weights sliced in project (dc1) and in the motion GRU (g0)
+        self.sliced_links = ('dc1', 'g0')
         self.name = self.__class__.__name__
 
         with self.init_scope():
@@ -52,72 +92,284 @@ class ImageGenerator(chainer.Chain):
             self.bn3 = L.BatchNormalization(n_filters*2)
             self.bn4 = L.BatchNormalization(n_filters)
 
+            if progressive:
+                self.rgb4 = L.Convolution2D(n_filters, out_channels, 1, initialW=w)
+
     def make_hidden(self, batchsize, size):
         return np.random.normal(0, 0.33, size=[batchsize, size]).astype(np.float32)
 
     def to_one_hot(self, zl, xp):
         return xp.eye(self.dim_zl, dtype=np.float32)[zl]
 
-    def make_zm(self, batchsize, zl, xp):
-        """ make zm vectors """
+    def motion_inputs(self, zl):
+        """
+        Input projections of the motion GRU (g0) for the gates [r, z, h_bar]:
+        the weights of the eps part of the input, and the biases of both
+        projections folded together. The label part is computed once per
+        batch and folded into the biases.
+
+        input zl shape: (batchsize, dim_zl) or None
+        :return: list of (weight, bias) per gate, bias shape: (dim_zm,) or
+                 (batchsize, dim_zm) with labels
+        """
+        g = self.g0
+        gates = [(g.W_r.W, g.W_r.b + g.U_r.b), (g.W_z.W, g.W_z.b + g.U_z.b), (g.W.W, g.W.b)]
+        if zl is None:
+            return gates
+
+        # inputs are [zl, et]
+        return [(W[:, self.dim_zl:], F.linear(zl, W[:, :self.dim_zl], b)) for W, b in gates]
+
+    def recur_motion(self, h, eps, zl=None):
+        """
+        Motion GRU, equivalent to applying g0 (StatelessGRU) step by step to
+        [zl, eps[t]]. Without backprop the input projections of all steps
+        are computed at once and the states are written to a preallocated
+        buffer.
+
+        input h shape:   (batchsize, dim_zm)
+        input eps shape: (video_length, batchsize, dim_zm), array
+        input zl shape:  (batchsize, dim_zl) or None
+        output shape: (video_length, batchsize, dim_zm), and the last state
+        """
+        g = self.g0
+        T, N, D = eps.shape
+        inputs = self.motion_inputs(zl)
+
+        def project(x, W, b):
+            # x W^T + b for x of shape (batchsize, D) or (T, batchsize, D)
+            y = F.linear(x.reshape(-1, D), W, b if b.ndim == 1 else None)
+            if x.ndim == 3:
+                y = F.reshape(y, x.shape)
+            return y if b.ndim == 1 else y + F.broadcast_to(b, y.shape)
+
+        backprop = chainer.config.enable_backprop
+        if backprop:
+            hs = []
+        else:
+            xp = chainer.cuda.get_array_module(h.data)
+            hs = xp.empty((T, N, D), dtype=h.dtype)
+            # indexing a step is a view here, with backprop its backward pass
+            # would allocate a gradient of all steps per step
+            xs = [project(eps, W, b) for W, b in inputs]
+
+        for t in range(T):
+            if backprop:
+                x_r, x_z, x_h = [project(eps[t], W, b) for W, b in inputs]
+            else:
+                x_r, x_z, x_h = [x[t] for x in xs]
+            r = F.sigmoid(x_r + F.linear(h, g.U_r.W))
+            z = F.sigmoid(x_z + F.linear(h, g.U_z.W))
+            h_bar = F.tanh(x_h + g.U(r * h))
+            h = F.linear_interpolate(z, h_bar, h)
+            if backprop:
+                hs.append(F.reshape(h, (1, N*D)))
+            else:
+                hs[t] = h.data
+
+        if backprop:
+            # stack without F.stack/F.concat, their backward pass goes through
+            # F.split_axis, which does not run on python>=3.10 with chainer 3
+            zm, = F.transpose_sequence(hs)
+            return F.reshape(zm, (T, N, D)), h
+
+        return Variable(hs), h
+
+    def make_zm(self, batchsize, zl, xp, h0=None, eps=None):
+        """
+        make zm vectors
+
+        :param h0: initial hidden state, shape: (batchsize, dim_zm), sampled if None
+        :param eps: GRU inputs, shape: (video_len, batchsize, dim_zm), sampled if None
+        """
 
         assert self.use_label == (zl is not None)
 
-        h0 = self.make_hidden(batchsize, self.dim_zm)
-        h0 = Variable(xp.asarray(h0))
+        if h0 is None:
+            h0 = self.make_hidden(batchsize, self.dim_zm)
+        if not isinstance(h0, Variable):
+            h0 = Variable(xp.asarray(h0))
 
-        ht = [h0]
-        for t in range(self.video_len):
-            et = Variable(xp.asarray(self.make_hidden(batchsize, self.dim_zm)))
-            
-            if self.use_label:
-                et = F.concat((zl, et))
+        if eps is None:
+            eps = np.random.normal(0, 0.33, size=[self.video_len, batchsize, self.dim_zm]).astype(np.float32)
+        eps = xp.asarray(eps)
 
-            ht.append(self.g0(ht[-1], et))
-        
-        zmt = [F.reshape(hk, (1, batchsize, self.dim_zm)) for hk in ht[1:]]
-        zm = F.concat(zmt, axis=0)
+        zm, _ = self.recur_motion(h0, eps, zl)
 
         return zm
 
-    def __call__(self, batchsize, xp=np):
+    def make_codes(self, batchsize, xp=np, zc=None, h0=None, eps=None, labels=None):
         """
-        input h0 shape:  (batchsize, dim_zm)
-        input zc shape:  (batchsize, dim_zc)
-        output shape: (video_length, batchsize, channel, x, y)
+        output zc shape: (batchsize, dim_zc)
+        output zm shape: (video_length, batchsize, dim_zm)
+
+        Latent codes which are not given are sampled randomly.
+
+        :param zc: content codes, shape: (batchsize, dim_zc)
+        :param h0: initial motion hidden states, shape: (batchsize, dim_zm)
+        :param eps: motion GRU inputs, shape: (video_len, batchsize, dim_zm)
+        :param labels: category labels, shape: (batchsize,)
         """
 
         # make zl
         if self.use_label:
-            labels = xp.random.randint(self.dim_zl, size=batchsize)
+            if labels is None:
+                labels = xp.random.randint(self.dim_zl, size=batchsize)
+            labels = xp.asarray(labels)
             zl = Variable(self.to_one_hot(labels, xp))
         else:
             labels = None
             zl = None
 
         # make zm
-        zm = self.make_zm(batchsize, zl, xp)
+        zm = self.make_zm(batchsize, zl, xp, h0, eps)
         
         # make zc
-        zc = Variable(xp.asarray(self.make_hidden(batchsize, self.dim_zc)))
+        if zc is None:
+            zc = self.make_hidden(batchsize, self.dim_zc)
+        zc = Variable(xp.asarray(zc))
+
+        return zc, zm, labels
+
+    def make_z(self, batchsize, xp=np, **codes):
+        """
+        output z shape: (video_length*batchsize, n_hidden, 1, 1)
+
+        See make_codes for the optional latent codes.
+        """
+        zc, zm, labels = self.make_codes(batchsize, xp, **codes)
         zc = F.tile(zc, (self.video_len, 1, 1))
         
         # [zc, zm]
         z = F.concat((zc, zm), axis=2)
         z = F.reshape(z, (self.video_len*batchsize, self.n_hidden, 1, 1))
-        
-        # G(z)
-        x = F.relu(self.bn1(self.dc1(z)))
+
+        return z, labels
+
+    def project_content(self, zc):
+        """
+        Content part of the dc1 projection (without bias).
+        dc1 maps a 1x1 input, so it is linear in [zc, zm] and the content
+        part only has to be computed once per video.
+
+        input zc shape:  (batchsize, dim_zc)
+        output shape: (batchsize, n_filters*8, 4, 4)
+        """
+        zc = F.reshape(zc, (zc.shape[0], self.dim_zc, 1, 1))
+        W = self.dc1.W[:self.dim_zc]
+        return F.deconvolution_nd(zc, W, None, stride=self.dc1.stride, pad=self.dc1.pad)
+
+    def project_motion(self, zm):
+        """
+        Motion part of the dc1 projection (with bias)
+
+        input zm shape:  (batchsize, dim_zm)
+        output shape: (batchsize, n_filters*8, 4, 4)
+        """
+        zm = F.reshape(zm, (zm.shape[0], self.dim_zm, 1, 1))
+        W = self.dc1.W[self.dim_zc:]
+        return F.deconvolution_nd(zm, W, self.dc1.b, stride=self.dc1.stride, pad=self.dc1.pad)
+
+    def project(self, zc, zm):
+        """
+        dc1 projection of [zc, zm] without tiling zc over time
+
+        input zc shape:  (batchsize, dim_zc)
+        input zm shape:  (video_length, batchsize, dim_zm)
+        output shape: (video_length*batchsize, n_filters*8, 4, 4)
+        """
+        T, N = zm.shape[:2]
+        hc = self.project_content(zc)
+        hm = self.project_motion(F.reshape(zm, (T*N, self.dim_zm)))
+
+        hc = F.broadcast_to(F.expand_dims(hc, 0), (T,) + hc.shape)
+        hm = F.reshape(hm, (T, N) + hm.shape[1:])
+        h = hc + hm
+
+        return F.reshape(h, (T*N,) + h.shape[2:])
+
+    def decode(self, h):
+        """
+        input h shape:  (batchsize, n_filters*8, 4, 4), output of dc1
+        output shape: (batchsize, channel, x, y)
+        """
+        x = F.relu(self.bn1(h))
         x = F.relu(self.bn2(self.dc2(x)))
         x = F.relu(self.bn3(self.dc3(x)))
         x = F.relu(self.bn4(self.dc4(x)))
-        x = F.tanh(self.dc5(x))
-        x = F.reshape(x, (self.video_len, batchsize, self.out_channels, 64, 64))
+
+        if self.img_size == 32:
+            return F.tanh(self.rgb4(x))
+
+        y = F.tanh(self.dc5(x))
+        if self.progressive and self.alpha < 1:
+            low = F.unpooling_nd(F.tanh(self.rgb4(x)), 2, cover_all=False)
+            y = (1 - self.alpha) * low + self.alpha * y
+
+        return y
+
+    def render(self, z):
+        """
+        input z shape:  (batchsize, n_hidden, 1, 1)
+        output shape: (batchsize, channel, x, y)
+        """
+        return self.decode(self.dc1(z))
+
+    def stream(self, batchsize, length, xp=np, chunk=1, zc=None, h0=None, labels=None):
+        """
+        Generate a video of arbitrary length chunk by chunk (inference only).
+        The GRU hidden state is carried between chunks and the content
+        projection is computed once, so memory does not grow with length.
+
+        :param int length: num frames to generate
+        :param int chunk: num frames per yielded chunk
+        yield shape: (chunk, batchsize, channel, x, y), the last chunk may be shorter
+        """
+        with chainer.using_config('train', False), chainer.no_backprop_mode():
+            zl = None
+            if self.use_label:
+                if labels is None:
+                    labels = xp.random.randint(self.dim_zl, size=batchsize)
+                zl = Variable(self.to_one_hot(xp.asarray(labels), xp))
+
+            if zc is None:
+                zc = self.make_hidden(batchsize, self.dim_zc)
+            hc = self.project_content(Variable(xp.asarray(zc)))
+
+            if h0 is None:
+                h0 = self.make_hidden(batchsize, self.dim_zm)
+            h = Variable(xp.asarray(h0))
+
+            for start in range(0, length, chunk):
+                n = min(chunk, length - start)
+
+                eps = np.random.normal(0, 0.33, size=[n, batchsize, self.dim_zm]).astype(np.float32)
+                zm, h = self.recur_motion(h, xp.asarray(eps), zl)
+
+                hm = self.project_motion(F.reshape(zm, (n*batchsize, self.dim_zm)))
+                hm = F.reshape(hm, (n, batchsize) + hm.shape[1:])
+                x = hm + F.broadcast_to(F.expand_dims(hc, 0), hm.shape)
+                x = self.decode(F.reshape(x, (n*batchsize,) + x.shape[2:]))
+
+                yield x.data.reshape((n, batchsize) + x.shape[1:])
+
+    def __call__(self, batchsize, xp=np):
+        """
+        input h0 shape:  (batchsize, dim_zm)
+        input zc shape:  (batchsize, dim_zc)
+        output shape: (video_length, batchsize, channel, x, y)
+        """
+        zc, zm, labels = self.make_codes(batchsize, xp)
+
+        # G(z)
+        x = self.decode(self.project(zc, zm))
+        x = F.reshape(x, (self.video_len, batchsize) + x.shape[1:])
 
         return x, labels
 
 class ImageDiscriminator(chainer.Chain):
-    def __init__(self, in_channels=3, out_channels=1, n_filters=64, use_noise=False, noise_sigma=0.2):
+    def __init__(self, in_channels=3, out_channels=1, n_filters=64, use_noise=False, noise_sigma=0.2,
+                 progressive=False):
         super(ImageDiscriminator, self).__init__()
 
         self.in_channels  = in_channels
@@ -125,6 +377,8 @@ class ImageDiscriminator(chainer.Chain):
         self.n_filters    = n_filters
         self.use_noise    = use_noise
         self.noise_sigma  = noise_sigma
+        self.progressive  = progressive
+        self.alpha        = 1.0
         self.name = self.__class__.__name__
 
         with self.init_scope():
@@ -140,13 +394,23 @@ class ImageDiscriminator(chainer.Chain):
             self.bn3 = L.BatchNormalization(n_filters*4)
             self.bn4 = L.BatchNormalization(n_filters*8)
 
+            if progressive:
+                self.rgb2 = L.Convolution2D(in_channels, n_filters, 1, initialW=w)
+
     def __call__(self, x):
         """
-        input shape:  (batchsize, 3, 64, 64)
+        input shape:  (batchsize, 3, 64, 64) or (batchsize, 3, 32, 32) if progressive
         output shape: (batchsize, 1)
         """
         y = add_noise(x, self.use_noise, self.noise_sigma)
-        y = F.leaky_relu(self.dc1(y), slope=0.2)
+        if x.shape[-1] == 32:
+            y = F.leaky_relu(self.rgb2(y), slope=0.2)
+        else:
+            y = F.leaky_relu(self.dc1(y), slope=0.2)
+            if self.progressive and self.alpha < 1:
+                low = F.average_pooling_nd(x, 2)
+                low = F.leaky_relu(self.rgb2(low), slope=0.2)
+                y = (1 - self.alpha) * low + self.alpha * y
         y = add_noise(y, self.use_noise, self.noise_sigma)
         y = F.leaky_relu(self.bn2(self.dc2(y)), slope=0.2)
         y = add_noise(y, self.use_noise, self.noise_sigma)
@@ -158,7 +422,8 @@ class ImageDiscriminator(chainer.Chain):
         return y
 
 class VideoDiscriminator(chainer.Chain):
-    def __init__(self, in_channels=3, out_channels=1, n_filters=64, use_noise=False, noise_sigma=0.2):
+    def __init__(self, in_channels=3, out_channels=1, n_filters=64, use_noise=False, noise_sigma=0.2,
+                 progressive=False):
         super(VideoDiscriminator, self).__init__()
         
         self.in_channels  = in_channels
@@ -166,8 +431,13 @@ class VideoDiscriminator(chainer.Chain):
         self.n_filters    = n_filters
         self.use_noise    = use_noise
         self.noise_sigma  = noise_sigma
+        self.progressive  = progressive
+        self.alpha        = 1.0
         self.name = self.__class__.__name__
 
+        # run the 3D convolutions as 2D convolutions, see model.backend
+        self.temporal_slices = False
+
         with self.init_scope():
             w = chainer.initializers.GlorotNormal()
 
@@ -181,20 +451,56 @@ class VideoDiscriminator(chainer.Chain):
             self.bn3 = L.BatchNormalization(n_filters*4)
             self.bn4 = L.BatchNormalization(n_filters*8)
 
+            if progressive:
+                self.rgb2 = L.ConvolutionND(3, in_channels, n_filters, 1, initialW=w)
+
+    def conv(self, link, x, pad_t):
+        """ apply a convolution link with the given temporal padding """
+        # links built with int pad/stride (rgb2) keep them as ints
+        link_pad = conv_nd.as_tuple(link.pad, 3)
+        stride = conv_nd.as_tuple(link.stride, 3)
+        pad = (pad_t,) + link_pad[1:]
+        if self.temporal_slices:
+            return convolution_3d_by_2d(x, link.W, link.b, stride, pad)
+        if pad_t == link_pad[0]:
+            return link(x)
+        return F.convolution_nd(x, link.W, link.b, stride=stride, pad=pad)
+
     def __call__(self, x):
         """
         input shape:  (batchsize, 1, 16, 64, 64)
         output shape: (batchsize, 1)
+
+        Shorter clips (down to 8 frames) are padded temporally, 32x32 inputs
+        skip dc1 if progressive, and outputs of longer clips are averaged over time.
         """
+        low_res = x.shape[-1] == 32
+        num_layers = 3 if low_res else 4
+        T = x.shape[2]
+        pad_t = 0 if T - 3*num_layers >= 4 else 1
+        if T - num_layers < 4:
+            raise ValueError('video is too short: {} frames'.format(T))
+
         y = add_noise(x, self.use_noise, self.noise_sigma)
-        y = F.leaky_relu(self.dc1(y), slope=0.2)
+        if low_res:
+            y = F.leaky_relu(self.conv(self.rgb2, y, 0), slope=0.2)
+        else:
+            y = F.leaky_relu(self.conv(self.dc1, y, pad_t), slope=0.2)
+            if self.progressive and self.alpha < 1:
+                low = F.average_pooling_nd(x, (1, 2, 2))
+                low = F.leaky_relu(self.conv(self.rgb2, low, 0), slope=0.2)
+                # dc1 shortens the clip by its temporal kernel, crop the 1x1x1 path to match
+                low = low[:, :, low.shape[2] - y.shape[2]:]
+                y = (1 - self.alpha) * low + self.alpha * y
         y = add_noise(y, self.use_noise, self.noise_sigma)
-        y = F.leaky_relu(self.bn2(self.dc2(y)), slope=0.2)
+        y = F.leaky_relu(self.bn2(self.conv(self.dc2, y, pad_t)), slope=0.2)
         y = add_noise(y, self.use_noise, self.noise_sigma)
-        y = F.leaky_relu(self.bn3(self.dc3(y)), slope=0.2)
+        y = F.leaky_relu(self.bn3(self.conv(self.dc3, y, pad_t)), slope=0.2)
         y = add_noise(y, self.use_noise, self.noise_sigma)
-        y = F.leaky_relu(self.bn4(self.dc4(y)), slope=0.2)
-        y = self.dc5(y)
+        y = F.leaky_relu(self.bn4(self.conv(self.dc4, y, pad_t)), slope=0.2)
+        y = self.conv(self.dc5, y, 0)
+        if y.shape[2] > 1:
+            y = F.mean(y, axis=2, keepdims=True)
 
         return y
 
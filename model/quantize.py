@@ -0,0 +1,144 @@
+"""
+Int8 weight storage of the ImageGenerator deconvolution stack
+
+Each deconvolution is folded with its following batch normalization
+(using the running statistics) and its weights are stored as int8 with
+one scale per output channel, which makes the saved generator about 4x
+smaller.
+
+This is a storage format, not a faster inference path: numpy has no int8
+GEMM kernel (integer np.dot does not use BLAS), so the weights are
+dequantized to float32 once when the layers are built and rendering runs
+float32 deconvolutions, at the speed of the float generator.
+"""
+import numpy as np
+import chainer
+import chainer.functions as F
+from chainer.utils import conv_nd
+
+QMAX = 127
+
+LAYERS = ('dc1', 'dc2', 'dc3', 'dc4', 'dc5')
+NORMS  = ('bn1', 'bn2', 'bn3', 'bn4', None)
+
+def as_array(x):
+    if isinstance(x, chainer.Variable):
+        x = x.data
+    return chainer.cuda.to_cpu(x)
+
+def quantize(x, scale):
+    """
+    Quantize x to int8 with the given (broadcastable) scale
+    """
+    return np.clip(np.rint(x / scale), -QMAX, QMAX).astype(np.int8)
+
+def fold_batch_normalization(deconv, bn):
+    """
+    Fold a batch normalization (test mode) into the preceding deconvolution
+
+    :return: folded weight (in, out, kh, kw) and bias (out,)
+    """
+    W = chainer.cuda.to_cpu(deconv.W.data).astype(np.float32)
+    if deconv.b is None:
+        b = np.zeros(W.shape[1], dtype=np.float32)
+    else:
+        b = chainer.cuda.to_cpu(deconv.b.data).astype(np.float32)
+
+    if bn is None:
+        return W, b
+
+    gamma = chainer.cuda.to_cpu(bn.gamma.data)
+    beta  = chainer.cuda.to_cpu(bn.beta.data)
+    mean  = chainer.cuda.to_cpu(bn.avg_mean)
+    var   = chainer.cuda.to_cpu(bn.avg_var)
+    s = gamma / np.sqrt(var + bn.eps)
+
+    W = W * s[None, :, None, None]
+    b = (b - mean) * s + beta
+
+    return W.astype(np.float32), b.astype(np.float32)
+
+class Int8WeightDeconvolution2D(object):
+    def __init__(self, Wq, w_scale, b, stride, pad):
+        self.Wq = Wq           # (in, out, kh, kw), int8
+        self.w_scale = w_scale # (out,)
+        self.b = b             # (out,)
+        self.stride = stride
+        self.pad = pad
+
+        # dequantized once, the layer runs in float32
+        self.W = Wq.astype(np.float32) * w_scale[None, :, None, None]
+
+    @classmethod
+    def from_float(cls, W, b, stride, pad):
+        w_amax = np.abs(W).max(axis=(0, 2, 3))
+        w_scale = np.maximum(w_amax, 1e-8) / QMAX
+        Wq = quantize(W, w_scale[None, :, None, None])
+
+        return cls(Wq, w_scale.astype(np.float32), b, stride, pad)
+
+    def __call__(self, x):
+        """
+        input shape:  (batchsize, in, h, w), float32
+        output shape: (batchsize, out, out_h, out_w), float32
+        """
+        return F.deconvolution_2d(x, self.W, self.b, stride=self.stride, pad=self.pad).data
+
+class Int8WeightImageGenerator(object):
+    """
+    ImageGenerator.render with int8 stored weights for CPU inference.
+    Latent vectors still come from the float ImageGenerator.make_z.
+    """
+    def __init__(self, layers):
+        self.layers = layers
+
+    @classmethod
+    def from_generator(cls, gen):
+        """
+        :param ImageGenerator gen: trained generator
+        """
+        layers = []
+        for dc, bn in zip(LAYERS, NORMS):
+            deconv = getattr(gen, dc)
+            W, b = fold_batch_normalization(deconv, None if bn is None else getattr(gen, bn))
+            layers.append(Int8WeightDeconvolution2D.from_float(
+                W, b, conv_nd.as_tuple(deconv.stride, 2), conv_nd.as_tuple(deconv.pad, 2)))
+
+        return cls(layers)
+
+    def render(self, z):
+        """
+        input z shape:  (batchsize, n_hidden, 1, 1)
+        output shape: (batchsize, channel, x, y)
+        """
+        x = as_array(z)
+        with chainer.no_backprop_mode():
+            for layer in self.layers[:-1]:
+                x = np.maximum(layer(x), 0)
+
+            return np.tanh(self.layers[-1](x))
+
+    def save_npz(self, path):
+        params = {}
+        for i, layer in enumerate(self.layers):
+            params['{}/Wq'.format(LAYERS[i])] = layer.Wq
+            params['{}/w_scale'.format(LAYERS[i])] = layer.w_scale
+            params['{}/b'.format(LAYERS[i])] = layer.b
+            params['{}/stride'.format(LAYERS[i])] = np.asarray(layer.stride)
+            params['{}/pad'.format(LAYERS[i])] = np.asarray(layer.pad)
+        with open(str(path), 'wb') as f:
+            np.savez_compressed(f, **params)
+
+    @classmethod
+    def load_npz(cls, path):
+        params = np.load(str(path))
+        layers = []
+        for dc in LAYERS:
+            layers.append(Int8WeightDeconvolution2D(
+                params['{}/Wq'.format(dc)],
+                params['{}/w_scale'.format(dc)],
+                params['{}/b'.format(dc)],
+                tuple(params['{}/stride'.format(dc)]),
+                tuple(params['{}/pad'.format(dc)])))
+
+        return cls(layers)
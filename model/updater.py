@@ -15,6 +15,10 @@ class Updater(chainer.training.StandardUpdater):
         self.channel  = kwargs.pop('channel')
         self.dim_zl  = kwargs.pop('dim_zl')
         self.tf_writer = kwargs.pop('tensorboard_writer')
+        self.augmentation = kwargs.pop('augmentation', None)
+
+        # weight of the full resolution input while it fades in (progressive training)
+        self.alpha = 1.0
 
         super(Updater, self).__init__(*args, **kwargs)
     
@@ -75,6 +79,32 @@ class Updater(chainer.training.StandardUpdater):
 
         return F.concat((video, label_video), axis=1)
 
+    def match_stage(self, video, xp):
+        """
+        Crop and downsample a real video batch to the current clip length
+        and resolution, fading in full resolution while alpha < 1
+
+        :param np.ndarray video: shape: (batchsize, channel, video_length, height, width)
+        """
+        N, C, T, H, W = video.shape
+        if T > self.video_length:
+            start = np.random.randint(0, T - self.video_length + 1)
+            video = video[:, :, start:start+self.video_length]
+            T = self.video_length
+
+        if self.img_size < H:
+            # low resolution stage
+            f = H // self.img_size
+            return video.reshape(N, C, T, H//f, f, W//f, f).mean(axis=(4, 6))
+
+        if self.alpha < 1:
+            # fade in: blend with the upsampled half resolution video
+            low = video.reshape(N, C, T, H//2, 2, W//2, 2).mean(axis=(4, 6))
+            low = xp.repeat(xp.repeat(low, 2, axis=3), 2, axis=4)
+            return ((1 - self.alpha) * low + self.alpha * video).astype(video.dtype)
+
+        return video
+
     def update_core(self):
         ## load models
         image_gen_optimizer = self.get_optimizer('image_gen')
@@ -87,9 +117,13 @@ class Updater(chainer.training.StandardUpdater):
         batch = self.get_iterator('main').next()
         batchsize = len(batch)
         x_real, t_real = concat_examples(batch)
-        x_real = Variable(self.converter(x_real, self.device))
-        xp = chainer.cuda.get_array_module(x_real.data)
-        t_real = Variable(xp.asarray(t_real).astype(np.int))
+        x_real = chainer.dataset.to_device(self.device, x_real)
+        xp = chainer.cuda.get_array_module(x_real)
+        if self.augmentation is not None:
+            x_real = self.augmentation(x_real)
+        x_real = Variable(self.match_stage(x_real, xp))
+        if t_real is not None:
+            t_real = Variable(xp.asarray(t_real).astype(np.int32))
         if self.model == 'cgan':
             # concat label features
             x_real = self.concat_label_video(x_real, t_real, xp)
@@ -100,7 +134,8 @@ class Updater(chainer.training.StandardUpdater):
         ## fake data
         x_fake, t_fake = image_gen(batchsize, xp)
         x_fake = x_fake.transpose(1, 2, 0, 3, 4) # (T, N, C, H, W) -> (N, C, T, H, W)
-        t_fake = Variable(xp.asarray(t_fake).astype(np.int))
+        if t_fake is not None:
+            t_fake = Variable(xp.asarray(t_fake).astype(np.int32))
         if self.model == 'cgan':
             # concat label features
             x_fake = self.concat_label_video(x_fake, t_fake, xp)
@@ -111,3 +146,40 @@ class Updater(chainer.training.StandardUpdater):
         image_dis_optimizer.update(self.loss_dis, image_dis, y_real_i, y_fake_i, t_real, t_fake)
         video_dis_optimizer.update(self.loss_dis, video_dis, y_real_v, y_fake_v, t_real, t_fake)
         image_gen_optimizer.update(self.loss_gen, image_gen, y_fake_i, y_fake_v, t_fake)
+
+class ProgressiveSchedule(chainer.training.Extension):
+    """
+    Progressive training schedule: train at start_size resolution and
+    start_length frames for stage_epochs epochs, then switch to the full
+    clip length and fade in the full resolution over fade_epochs epochs.
+    """
+    trigger = 1, 'iteration'
+    priority = chainer.training.PRIORITY_WRITER
+
+    def __init__(self, updater, stage_epochs, fade_epochs, start_size=32, start_length=8,
+                 full_size=64, full_length=16):
+        self.updater = updater
+        self.stage_epochs = stage_epochs
+        self.fade_epochs = fade_epochs
+        self.start_size, self.start_length = start_size, start_length
+        self.full_size, self.full_length = full_size, full_length
+
+    def apply(self, epoch_detail):
+        if epoch_detail < self.stage_epochs:
+            img_size, video_length, alpha = self.start_size, self.start_length, 1.0
+        else:
+            img_size, video_length = self.full_size, self.full_length
+            if self.start_size == self.full_size or self.fade_epochs <= 0:
+                alpha = 1.0
+            else:
+                alpha = min(1.0, (epoch_detail - self.stage_epochs) / self.fade_epochs)
+
+        updater = self.updater
+        updater.img_size, updater.video_length, updater.alpha = img_size, video_length, alpha
+        updater.image_gen.img_size = img_size
+        updater.image_gen.video_len = video_length
+        for net in (updater.image_gen, updater.image_dis, updater.video_dis):
+            net.alpha = alpha
+
+    def __call__(self, trainer):
+        self.apply(trainer.updater.epoch_detail)
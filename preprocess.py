@@ -9,6 +9,11 @@ Perform following preprocessing for MUG Facial Expression Database
 To use this script, pass the arguments
 MUG dataset directory and save directory.
 
+With --format shards, clips are written as sequential tar shards of
+JPEG frames instead of a directory tree (see datasets.ShardDataset).
+With --format clip, each clip is written as one temporally predicted .clip
+file (see clipfile.py), JPEG coded at --clip_quality or lossless if 0.
+
 I suppose that dataset path is 'subject3' directory
 in MUG dataset
 
@@ -24,11 +29,17 @@ in MUG dataset
            :
 """
 import argparse
-import sys, os, glob, shutil
+import sys, os, glob
+import io
+import json
+import random
+import tarfile
 import cv2
 import re
 import multiprocessing
 
+from clipfile import write_clip
+
 CASCADE_PATH = "data/haarcascade_frontalface_default.xml"
 
 frame_name_regex = re.compile(r'([0-9]+).jpg')
@@ -50,10 +61,18 @@ def detect_face(image):
 
     return rect
 
-def perform_preprocess_multi(args):
-    perform_preprocess(*args)
+def extract_video_info(in_dir):
+    """
+    return (user, session, expression, take) of <user>/<expression>/<take>,
+    session is always 0 as it is not part of the directory layout
+    """
+    parts = os.path.normpath(in_dir).split(os.sep)
+    number = lambda s: int(re.sub(r'[^0-9]', '', s) or 0)
 
-def perform_preprocess(in_dir, save_path, options):
+    return number(parts[-3]), 0, parts[-2], number(parts[-1])
+
+def extract_clips(in_dir, options):
+    """ yield (clip name, list of cropped 64x64 BGR frames) """
     images = glob.glob(os.path.join(in_dir, '*.jpg'))
     images = sorted(images, key=frame_number)
 
@@ -63,22 +82,20 @@ def perform_preprocess(in_dir, save_path, options):
     start = 0
     end   = len(images) - edge_frames
 
-    num_created_samples = 0
     for speed in speeds:
         frame_width = speed*length
         for seq_n, offset in enumerate(range(start, end-frame_width, stride)[0:-1]):
             user_num, session_num, expression, take_num = extract_video_info(in_dir)
-            out_dir = os.path.join(save_path, "user{:03d}_sess{}_take{:03d}_{:02d}".format(user_num, session_num, take_num, seq_n))
-            os.makedirs(out_dir, exist_ok=True)
+            name = "user{:03d}_sess{}_take{:03d}_{:02d}".format(user_num, session_num, take_num, seq_n)
         
             # detect face region of the video clip
             mid_frame = offset + frame_width//2
             image = cv2.imread(images[mid_frame])
             rect = detect_face(image)
             if rect is None:
-                shutil.rmtree(out_dir)
                 continue
             
+            frames = []
             for k in range(length):
                 # read img
                 image = cv2.imread(images[offset+speed*k])
@@ -89,38 +106,131 @@ def perform_preprocess(in_dir, save_path, options):
                 image = image[y:y+h, x:x+w]
 
                 # resize 64, 64
-                image = cv2.resize(image,(64, 64))
+                frames.append(cv2.resize(image,(64, 64)))
 
-                # save
-                image_name = "{:02d}.jpg".format(k+1)
-                cv2.imwrite(os.path.join(out_dir, image_name) , image)
-
-            num_created_samples += 1
             print("{}({} frames) --> {}(offset:{}, speed:{})".format(
                                                     '/'.join(in_dir.split('/')[-3:]),
-                                                    len(images),
-                                                    '/'.join(out_dir.split('/')[-2:]),
-                                                    offset, speed))
+                                                    len(images), name, offset, speed))
+            yield name, frames
+
+def perform_preprocess_multi(args):
+    perform_preprocess(*args)
+
+def perform_preprocess(in_dir, save_path, options, clip_format='dir', clip_quality=90):
+    num_created_samples = 0
+    for name, frames in extract_clips(in_dir, options):
+        if clip_format == 'clip':
+            video = [image[:, :, ::-1] for image in frames] # BGR -> RGB
+            write_clip(os.path.join(save_path, name + '.clip'), video, quality=clip_quality)
+            num_created_samples += 1
+            continue
+
+        out_dir = os.path.join(save_path, name)
+        os.makedirs(out_dir, exist_ok=True)
+
+        for k, image in enumerate(frames):
+            image_name = "{:02d}.jpg".format(k+1)
+            cv2.imwrite(os.path.join(out_dir, image_name) , image)
+
+        num_created_samples += 1
     print("")
 
     return num_created_samples
 
+def encode_clips(args):
+    """ return [(clip name, label, [jpeg bytes])] of a video """
+    in_dir, label, options = args
+    clips = []
+    for name, frames in extract_clips(in_dir, options):
+        jpegs = [cv2.imencode('.jpg', image)[1].tobytes() for image in frames]
+        clips.append(("{}_{}".format(label, name), label, jpegs))
+
+    return clips
+
+class ShardWriter(object):
+    """
+    Write clips sequentially into tar shards of at most shard_size clips.
+    A clip <key> is stored as members <key>.<frame>.jpg and <key>.cls, and
+    manifest.json lists the shards with their number of clips.
+    """
+    def __init__(self, save_path, shard_size=1000, **info):
+        self.save_path = save_path
+        self.shard_size = shard_size
+        self.info = info
+        self.shards = []
+        self.tar = None
+        os.makedirs(save_path, exist_ok=True)
+
+    def add(self, key, data):
+        info = tarfile.TarInfo(key)
+        info.size = len(data)
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def write(self, key, label, jpegs):
+        if self.tar is None or self.shards[-1]['num'] >= self.shard_size:
+            self.next_shard()
+
+        for k, jpeg in enumerate(jpegs):
+            self.add("{}.{:02d}.jpg".format(key, k+1), jpeg)
+        self.add("{}.cls".format(key), str(label).encode('utf-8'))
+        self.shards[-1]['num'] += 1
+
+    def next_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+        name = "shard-{:05d}.tar".format(len(self.shards))
+        self.tar = tarfile.open(os.path.join(self.save_path, name), 'w')
+        self.shards.append({'name': name, 'num': 0})
+
+    def close(self):
+        if self.tar is not None:
+            self.tar.close()
+        manifest = dict(self.info, shards=self.shards)
+        with open(os.path.join(self.save_path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
 def main():
     parser = argparse.ArgumentParser(description='Preprocessing script for MUG Facial Expression Database')
     parser.add_argument('dataset_path', type=str)
     parser.add_argument('save_path', type=str)
     parser.add_argument('--process', "-p", type=int, default=1, help="num working process")
+    parser.add_argument('--format', choices=['dir', 'shards', 'clip'], default='dir', help="output format")
+    parser.add_argument('--shard_size', type=int, default=1000, help="num clips per shard")
+    parser.add_argument('--clip_quality', type=int, default=90, help="JPEG quality of .clip files (0: lossless)")
     args = parser.parse_args()
 
     edge   = 0.10 # dont use end of frames of the video
     speeds = [2] # use 1 frame per speed frames ( to change speed )
     length = 16 # video length (frame num)
     stride = length // 2 # stride width
-    options = (edge speeds, length, stride)
+    options = (edge, speeds, length, stride)
 
     # list all video clips
     facial_expressions = ["anger", "disgust", "happiness",
                           "fear", "sadness", "surprise"]
+
+    if args.format == 'shards':
+        # shuffle videos once so that shards are not sorted by category
+        videos = []
+        for label, exp in enumerate(facial_expressions):
+            video_paths = glob.glob(os.path.join(args.dataset_path, '*', exp, '*'))
+            print(">>> {}: {} video clips found.".format(exp, len(video_paths)))
+            videos += [(path, label, options) for path in video_paths]
+        random.Random(0).shuffle(videos)
+
+        writer = ShardWriter(args.save_path, args.shard_size,
+                             num_labels=len(facial_expressions), length=length)
+        pool = multiprocessing.Pool(args.process)
+        for clips in pool.imap(encode_clips, videos):
+            for key, label, jpegs in clips:
+                writer.write(key, label, jpegs)
+        pool.close()
+        writer.close()
+
+        print(">>> preprocess finished, {} video clips were written into {} shards.".format(
+                sum(s['num'] for s in writer.shards), len(writer.shards)))
+        return
+
     num_orginal_samples = 0
     for label, exp in enumerate(facial_expressions):
         video_paths = glob.glob(os.path.join(args.dataset_path, '*', exp, '*'))
@@ -137,12 +247,13 @@ def main():
         if args.process == 1:
             print('working on single process')
             for video_path in video_paths:
-                perform_preprocess(video_path, category_path, options)
+                perform_preprocess(video_path, category_path, options, args.format, args.clip_quality)
         else:
             print('working on multi process({})'.format(args.process))
             video_num = len(video_paths)
             num_orginal_samples += video_num
-            args_iter = zip(video_paths, [category_path]*video_num, [options]*video_num)
+            args_iter = zip(video_paths, [category_path]*video_num, [options]*video_num,
+                            [args.format]*video_num, [args.clip_quality]*video_num)
             pool = multiprocessing.Pool(args.process)
             pool.map(perform_preprocess_multi, args_iter)
             pool.close()
@@ -0,0 +1,78 @@
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+
+import chainer
+from chainer import serializers
+
+from model.net import ImageGenerator
+from model.quantize import Int8WeightImageGenerator, LAYERS, NORMS, as_array
+
+def measure(render, zs, repeat):
+    """ return best seconds per call of render over zs """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for z in zs:
+            render(z)
+        best = min(best, (time.perf_counter() - start) / len(zs))
+
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Store the image generator weights as int8 (4x smaller, not faster)')
+    parser.add_argument('model_weight')
+    parser.add_argument('save_path', help='path of the int8 weight .npz')
+    parser.add_argument('--num', '-n', type=int, default=36, help='num videos per evaluation batch')
+    parser.add_argument('--num_batches', type=int, default=4, help='num evaluation batches')
+    parser.add_argument('--repeat', type=int, default=3, help='num timing repeats')
+    args = parser.parse_args()
+
+    gen = ImageGenerator()
+    serializers.load_npz(args.model_weight, gen)
+
+    print(">>> quantizing...")
+    qgen = Int8WeightImageGenerator.from_generator(gen)
+    qgen.save_npz(args.save_path)
+    with chainer.using_config('train', False), chainer.no_backprop_mode():
+        eval_zs = [gen.make_z(args.num, np)[0] for _ in range(args.num_batches)]
+
+    print(">>> evaluating...")
+    with chainer.using_config('train', False), chainer.no_backprop_mode():
+        float_render = lambda z: gen.render(z).data
+        float_time = measure(float_render, eval_zs, args.repeat)
+        int8_time  = measure(qgen.render, eval_zs, args.repeat)
+
+        # compare on the uint8 pixel scale used when saving samples
+        se, ae, max_err = 0., 0., 0.
+        for z in eval_zs:
+            ref = (as_array(float_render(z)) / 2. + 0.5) * 255
+            out = (qgen.render(z) / 2. + 0.5) * 255
+            err = np.abs(ref - out)
+            se += np.mean(err ** 2)
+            ae += np.mean(err)
+            max_err = max(max_err, err.max())
+        mse = se / len(eval_zs)
+        psnr = 10 * np.log10(255. ** 2 / max(mse, 1e-12))
+
+    num_videos = args.num
+    float_size = sum(p.data.nbytes for name in LAYERS + NORMS if name is not None
+                                   for p in getattr(gen, name).params())
+    int8_size  = Path(args.save_path).stat().st_size
+
+    print('')
+    print('[ Int8 weight report ]')
+    print('{:<24}{:>14}{:>14}'.format('', 'float32', 'int8 weights'))
+    print('{:<24}{:>14.2f}{:>14.2f}'.format('ms / video', 1e3 * float_time / num_videos,
+                                                          1e3 * int8_time / num_videos))
+    print('{:<24}{:>14.1f}{:>14.1f}'.format('videos / s', num_videos / float_time,
+                                                          num_videos / int8_time))
+    print('{:<24}{:>14}{:>14.2f}'.format('PSNR [dB]', 'inf', psnr))
+    print('{:<24}{:>14}{:>14.3f}'.format('mean abs err [0-255]', '0', ae / len(eval_zs)))
+    print('{:<24}{:>14}{:>14.1f}'.format('max abs err [0-255]', '0', max_err))
+    print('{:<24}{:>14.1f}{:>14.1f}'.format('weights [KiB]', float_size / 1024., int8_size / 1024.))
+
+if __name__=="__main__":
+    main()
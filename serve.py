@@ -0,0 +1,300 @@
+"""
+Long-lived sampling service for a trained ImageGenerator
+
+The generator is loaded once and concurrent requests are merged into
+micro-batches: a batch is run as soon as it holds --max_batch videos or
+the oldest request has waited --max_latency milliseconds.
+
+  POST /generate  {"content_seeds": [..], "motion_seeds": [..],
+                   "labels": [..], "num": n, "format": "npy" | "gif"}
+      returns uint8 frames as .npy (shape: (num, T, H, W, C))
+      or a gif (videos are tiled into a grid)
+  GET  /metrics   queue depth and batch size statistics as json
+"""
+import argparse
+import io
+import json
+import queue
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image
+
+import chainer
+from chainer import serializers
+
+from model.net import ImageGenerator
+from util import to_grid
+
+def content_code(gen, seed):
+    rs = np.random.RandomState(seed)
+    return rs.normal(0, 0.33, size=gen.dim_zc).astype(np.float32)
+
+def motion_code(gen, seed):
+    """ return h0 (dim_zm,) and GRU inputs (video_len, dim_zm) """
+    rs = np.random.RandomState(seed)
+    h0  = rs.normal(0, 0.33, size=gen.dim_zm).astype(np.float32)
+    eps = rs.normal(0, 0.33, size=(gen.video_len, gen.dim_zm)).astype(np.float32)
+    return h0, eps
+
+def to_gif(videos):
+    """
+    :param np.ndarray videos: uint8 videos, shape: (num, T, H, W, C)
+    """
+    size = int(np.ceil(np.sqrt(len(videos))))
+    grid = to_grid(videos.transpose(1, 0, 4, 2, 3), size) # (T, C, H, W)
+    frames = [Image.fromarray(f) for f in grid.transpose(0, 2, 3, 1)]
+
+    buf = io.BytesIO()
+    frames[0].save(buf, format='GIF', save_all=True, append_images=frames[1:],
+                   duration=125, loop=0)
+    return buf.getvalue()
+
+class Request(object):
+    def __init__(self, zc, h0, eps, labels):
+        self.zc, self.h0, self.eps, self.labels = zc, h0, eps, labels
+        self.num = len(zc)
+        self.created = time.perf_counter()
+        self.done = threading.Event()
+        self.videos = None
+        self.error = None
+
+class MicroBatcher(object):
+    def __init__(self, gen, xp, max_batch=64, max_latency=20.):
+        self.gen = gen
+        self.xp  = xp
+        self.max_batch = max_batch
+        self.max_latency = max_latency / 1000.
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        # request which did not fit into the previous batch
+        self.held = None
+
+        # metrics
+        self.num_requests = 0
+        self.num_batches  = 0
+        self.num_videos   = 0
+        self.batch_sizes  = Counter()
+        self.wait_time    = 0.
+        self.gen_time     = 0.
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, request):
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.videos
+
+    def collect(self):
+        """
+        block until a batch is ready and return its requests,
+        a request which would exceed max_batch is held over for the next batch
+        """
+        if self.held is not None:
+            pending, self.held = [self.held], None
+        else:
+            pending = [self.queue.get()]
+        num = pending[0].num
+        deadline = pending[0].created + self.max_latency
+        while num < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if num + request.num > self.max_batch:
+                self.held = request
+                break
+            pending.append(request)
+            num += request.num
+
+        return pending
+
+    def generate(self, requests):
+        gen, xp = self.gen, self.xp
+        zc  = np.concatenate([r.zc for r in requests])
+        h0  = np.concatenate([r.h0 for r in requests])
+        eps = np.concatenate([r.eps for r in requests], axis=1)
+        labels = np.concatenate([r.labels for r in requests]) if gen.use_label else None
+        batchsize = len(zc)
+
+        with chainer.using_config('train', False), chainer.no_backprop_mode():
+            zc, zm, _ = gen.make_codes(batchsize, xp, zc=zc, h0=h0, eps=eps, labels=labels)
+            x = gen.decode(gen.project(zc, zm))
+        x = chainer.cuda.to_cpu(x.data)
+        x = x.reshape((gen.video_len, batchsize) + x.shape[1:])
+        x = ((x / 2. + 0.5) * 255).clip(0, 255).astype(np.uint8)
+
+        return x.transpose(1, 0, 3, 4, 2) # (N, T, H, W, C)
+
+    def run(self):
+        while True:
+            requests = self.collect()
+            start = time.perf_counter()
+            try:
+                videos = self.generate(requests)
+            except Exception as e:
+                for r in requests:
+                    r.error = e
+                    r.done.set()
+                continue
+            end = time.perf_counter()
+
+            offset = 0
+            for r in requests:
+                r.videos = videos[offset:offset+r.num]
+                offset += r.num
+                r.done.set()
+
+            with self.lock:
+                self.num_requests += len(requests)
+                self.num_batches  += 1
+                self.num_videos   += offset
+                self.batch_sizes[offset] += 1
+                self.wait_time    += sum(start - r.created for r in requests)
+                self.gen_time     += end - start
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'queue_depth':       self.queue.qsize(),
+                'num_requests':      self.num_requests,
+                'num_batches':       self.num_batches,
+                'num_videos':        self.num_videos,
+                'mean_batch_size':   self.num_videos / max(self.num_batches, 1),
+                'batch_sizes':       {str(k): v for k, v in sorted(self.batch_sizes.items())},
+                'mean_wait_ms':      1e3 * self.wait_time / max(self.num_requests, 1),
+                'mean_generate_ms':  1e3 * self.gen_time / max(self.num_batches, 1),
+            }
+
+def make_handler(batcher):
+    gen = batcher.gen
+
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, code, body, content_type):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def reply_json(self, code, obj):
+            self.reply(code, json.dumps(obj).encode('utf-8'), 'application/json')
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self.reply_json(200, batcher.metrics())
+            else:
+                self.reply_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/generate':
+                return self.reply_json(404, {'error': 'not found'})
+
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                params = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+                request, fmt = self.parse(params)
+            except (ValueError, TypeError) as e:
+                return self.reply_json(400, {'error': str(e)})
+
+            try:
+                videos = batcher.submit(request)
+            except Exception as e:
+                return self.reply_json(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+
+            if fmt == 'gif':
+                self.reply(200, to_gif(videos), 'image/gif')
+            else:
+                buf = io.BytesIO()
+                np.save(buf, videos)
+                self.reply(200, buf.getvalue(), 'application/octet-stream')
+
+        def parse(self, params):
+            fmt = params.get('format', 'npy')
+            if fmt not in ('npy', 'gif'):
+                raise ValueError('unknown format: {}'.format(fmt))
+
+            content_seeds = params.get('content_seeds')
+            motion_seeds  = params.get('motion_seeds')
+            labels        = params.get('labels')
+            num = int(params.get('num', 1))
+            for seeds in (content_seeds, motion_seeds, labels):
+                if seeds is not None:
+                    num = len(seeds)
+            if num < 1 or num > batcher.max_batch:
+                raise ValueError('num must be in [1, {}]'.format(batcher.max_batch))
+
+            if content_seeds is None:
+                content_seeds = np.random.randint(2**31, size=num)
+            if motion_seeds is None:
+                motion_seeds = np.random.randint(2**31, size=num)
+            if len(content_seeds) != num or len(motion_seeds) != num:
+                raise ValueError('content_seeds and motion_seeds must have the same length')
+
+            if gen.use_label:
+                if labels is None:
+                    labels = np.random.randint(gen.dim_zl, size=num)
+                labels = np.asarray(labels, dtype=np.int32)
+                if len(labels) != num or labels.min() < 0 or labels.max() >= gen.dim_zl:
+                    raise ValueError('labels must be {} integers in [0, {})'.format(num, gen.dim_zl))
+            elif labels is not None:
+                raise ValueError('the generator is not conditioned on labels')
+
+            zc = np.stack([content_code(gen, int(s)) for s in content_seeds])
+            motions = [motion_code(gen, int(s)) for s in motion_seeds]
+            h0  = np.stack([m[0] for m in motions])
+            eps = np.stack([m[1] for m in motions], axis=1)
+
+            return Request(zc, h0, eps, labels), fmt
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description='Sampling service with request micro-batching')
+    parser.add_argument('model_weight')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--gpu', '-g', type=int, default=-1)
+    parser.add_argument('--max_batch', type=int, default=64, help='max num videos per generator batch')
+    parser.add_argument('--max_latency', type=float, default=20., help='max time [ms] a request waits for a batch to fill')
+    parser.add_argument('--dim_zc', type=int, default=50, help='number of dimensions of z content')
+    parser.add_argument('--dim_zm', type=int, default=10, help='number of dimensions of z motion')
+    parser.add_argument('--dim_zl', type=int, default=0, help='number of labels (0 if not conditioned)')
+    parser.add_argument('--n_filters_gen', type=int, default=64, help='number of channels of image generator')
+    args = parser.parse_args()
+
+    gen = ImageGenerator(args.dim_zc, args.dim_zm, args.dim_zl, 3, args.n_filters_gen)
+    serializers.load_npz(args.model_weight, gen)
+
+    if args.gpu >= 0:
+        chainer.cuda.get_device_from_id(args.gpu).use()
+        gen.to_gpu()
+        xp = chainer.cuda.cupy
+    else:
+        xp = np
+
+    batcher = MicroBatcher(gen, xp, args.max_batch, args.max_latency)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher))
+
+    print(">>> serving on http://{}:{}".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__=="__main__":
+    main()
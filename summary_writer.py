@@ -0,0 +1,154 @@
+"""
+Dependency-free TensorBoard event writer
+
+Writes scalar and PNG image summaries as TFRecord event files readable by
+TensorBoard, without importing TensorFlow. The protobuf messages are
+encoded by hand; only the few fields used here are supported. Events are
+buffered and flushed every flush_secs seconds or max_queue events.
+"""
+import io
+import socket
+import struct
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+import chainer.cuda
+
+# {{{ crc32c (Castagnoli), as required by the TFRecord format
+def _make_crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+_CRC32C_TABLE = _make_crc32c_table()
+
+def crc32c(data):
+    crc = 0xFFFFFFFF
+    table = _CRC32C_TABLE
+    for b in data:
+        crc = table[(crc ^ b) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+def masked_crc32c(data):
+    crc = crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+# }}}
+
+# {{{ protobuf encoding
+def _varint(n):
+    out = bytearray()
+    while True:
+        bits = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(bits | 0x80)
+        else:
+            out.append(bits)
+            return bytes(out)
+
+def _key(field, wire_type):
+    return _varint((field << 3) | wire_type)
+
+def _int(field, value):
+    return _key(field, 0) + _varint(value)
+
+def _double(field, value):
+    return _key(field, 1) + struct.pack('<d', value)
+
+def _float(field, value):
+    return _key(field, 5) + struct.pack('<f', value)
+
+def _bytes(field, value):
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return _key(field, 2) + _varint(len(value)) + value
+
+def _event(step, summary=None, file_version=None):
+    """ tensorflow.Event """
+    msg = _double(1, time.time()) + _int(2, int(step))
+    if file_version is not None:
+        msg += _bytes(3, file_version)
+    if summary is not None:
+        msg += _bytes(5, summary)
+    return msg
+
+def _scalar_summary(tag, value):
+    """ tensorflow.Summary with one simple_value """
+    return _bytes(1, _bytes(1, tag) + _float(2, value))
+
+def _image_summary(tag, height, width, channels, png):
+    """ tensorflow.Summary with one image """
+    image = _int(1, height) + _int(2, width) + _int(3, channels) + _bytes(4, png)
+    return _bytes(1, _bytes(1, tag) + _bytes(4, image))
+# }}}
+
+def _record(data):
+    header = struct.pack('<Q', len(data))
+    return (header + struct.pack('<I', masked_crc32c(header)) +
+            data + struct.pack('<I', masked_crc32c(data)))
+
+class SummaryWriter(object):
+    """ Drop-in replacement of tb_chainer.SummaryWriter for scalars and images """
+    def __init__(self, log_dir, flush_secs=120, max_queue=10):
+        self.log_dir = Path(log_dir)
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        self.flush_secs = flush_secs
+        self.max_queue = max_queue
+
+        filename = 'events.out.tfevents.{:010d}.{}'.format(int(time.time()), socket.gethostname())
+        self.file = open(str(self.log_dir / filename), 'wb')
+        self.queue = []
+        self.last_flush = time.time()
+
+        self.add_event(_event(0, file_version='brain.Event:2'))
+        self.flush()
+
+    def add_event(self, event):
+        self.queue.append(_record(event))
+        if len(self.queue) >= self.max_queue or time.time() - self.last_flush >= self.flush_secs:
+            self.flush()
+
+    def add_scalar(self, tag, value, global_step=0):
+        if isinstance(value, chainer.Variable):
+            value = value.data
+        if not np.isscalar(value):
+            value = chainer.cuda.to_cpu(value)
+        value = float(value)
+        self.add_event(_event(global_step, _scalar_summary(tag, value)))
+
+    def add_image(self, tag, img, global_step=0):
+        """
+        :param np.ndarray img: image (dim=3, axis=(channel, height, width)),
+                               value range: [0, 1.0] for float, [0, 255] for uint8
+        """
+        img = np.asarray(chainer.cuda.to_cpu(img))
+        if img.ndim == 3:
+            img = img.transpose(1, 2, 0)
+            if img.shape[2] == 1:
+                img = img[:, :, 0]
+        if img.dtype != np.uint8:
+            img = (np.clip(img, 0, 1) * 255).astype(np.uint8)
+
+        buf = io.BytesIO()
+        Image.fromarray(img).save(buf, format='PNG')
+        height, width = img.shape[:2]
+        channels = 1 if img.ndim == 2 else img.shape[2]
+        self.add_event(_event(global_step, _image_summary(tag, height, width, channels, buf.getvalue())))
+
+    def flush(self):
+        if self.queue:
+            self.file.write(b''.join(self.queue))
+            self.queue = []
+        self.file.flush()
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        self.file.close()
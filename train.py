@@ -14,18 +14,25 @@ from chainer.training import extensions
 from model.net import ImageGenerator
 from model.net import ImageDiscriminator
 from model.net import VideoDiscriminator
-from model.updater import Updater
+from model.updater import Updater, ProgressiveSchedule
+from model.backend import BACKENDS, use_backend, select_kernels
 
-from datasets import MugDataset, MovingMnistDataset
+from datasets import MugDataset, MovingMnistDataset, ShardDataset, ShardIterator, SharedMemoryDataset
+from augmentation import AUGMENTATIONS, VideoAugmentation
 
 from util import log_tensorboard
-from tb_chainer import utils, SummaryWriter
+from summary_writer import SummaryWriter
+from evaluation import FeatureExtractor, FrechetEvaluator, frechet_evaluation
 
 def main():
     parser = argparse.ArgumentParser(description='Train script')
     parser.add_argument('--gpu', '-g', type=int, default=-1, help='GPU ID (negative value indicates CPU)')
-    parser.add_argument('--dataset_type', choices=['mug', 'mnist'], default='mug', help="dataset type")
-    parser.add_argument('--dataset', default='data/dataset/train', help="dataset root path")
+    parser.add_argument('--backend', choices=BACKENDS, default='numpy', help='CPU backend (ideep: falls back per layer)')
+    parser.add_argument('--dataset_type', choices=['mug', 'mnist', 'shards', 'shm'], default='mug', help="dataset type")
+    parser.add_argument('--dataset', default='data/dataset/train',
+                        help="dataset root path (shm: name of the segment served by dataset_host.py)")
+    parser.add_argument('--loader_processes', type=int, default=2, help="num processes reading shards (shards dataset)")
+    parser.add_argument('--shuffle_buffer', type=int, default=1000, help="num clips in the shuffle buffer (shards dataset)")
     parser.add_argument('--batchsize', type=int, default=100, help="batchsize")
     parser.add_argument('--max_epoch', type=int, default=1000, help="num learning epochs")
     parser.add_argument('--model', type=str, choices=['normal', 'cgan', 'infogan'], default="normal", help="MoCoGAN model")
@@ -34,12 +41,27 @@ def main():
     parser.add_argument('--display_interval', type=int, default=1, help='interval of displaying log to console')
     parser.add_argument('--snapshot_interval', type=int, default=10, help='interval of snapshot')
     parser.add_argument('--log_tensorboard_interval', type=int, default=10, help='interval of log to tensorboard (genenrate samples too)')
+    parser.add_argument('--tensorboard_backend', choices=['native', 'tb_chainer'], default='native',
+                        help='tensorboard event writer (tb_chainer requires tensorflow)')
     parser.add_argument('--num_gen_samples', type=int, default=36, help='num generate samples')
     parser.add_argument('--dim_zc', type=int, default=50, help='number of dimensions of z content')
     parser.add_argument('--dim_zm', type=int, default=10, help='number of dimensions of z motion')
     parser.add_argument('--n_filters_gen', type=int, default=64, help='number of channelsof image generator')
     parser.add_argument('--n_filters_idis', type=int, default=64, help='number of channel of image discriminator')
     parser.add_argument('--n_filters_vdis', type=int, default=64, help='number of channel of video discriminator')
+    parser.add_argument('--progressive', action='store_true', help='start at low resolution / short clips and grow')
+    parser.add_argument('--stage_epochs', type=int, default=50, help='num epochs of the low resolution stage')
+    parser.add_argument('--fade_epochs', type=int, default=10, help='num epochs to fade in full resolution')
+    parser.add_argument('--start_size', type=int, choices=[32, 64], default=32, help='image size of the first stage')
+    parser.add_argument('--start_length', type=int, default=8, help='video length of the first stage (>= 8)')
+    parser.add_argument('--augment', nargs='*', choices=AUGMENTATIONS, default=[], help='batched augmentations of real videos')
+    parser.add_argument('--crop_pad', type=int, default=4, help='max shift [px] of the crop augmentation')
+    parser.add_argument('--brightness', type=float, default=0.1, help='max offset of the brightness augmentation')
+    parser.add_argument('--fid_interval', type=int, default=0, help='interval of FID/FVD evaluation (0: disabled)')
+    parser.add_argument('--fid_samples', type=int, default=1024, help='num generated videos per FID/FVD evaluation')
+    parser.add_argument('--fid_image_dis', default='', help='image discriminator weights used as frame feature extractor')
+    parser.add_argument('--fid_video_dis', default='', help='video discriminator weights used as video feature extractor')
+    parser.add_argument('--fid_cache', default='data/fid_cache', help='cache directory of real data statistics')
     parser.add_argument('--resume', '-r', default='',
                         help='Resume the training from snapshot')
     args = parser.parse_args()
@@ -59,30 +81,46 @@ def main():
     # Set up dataset
     if args.dataset_type == "mug":
         num_labels = 6
-        train_dataset = MugDataset(args.dataset, video_length)
+        train_dataset = MugDataset(args.dataset, video_length, size)
     elif args.dataset_type == "mnist":
         num_labels = 0
-        train_dataset = MovingMnistDataset(args.dataset, video_length)
-    train_iter = chainer.iterators.SerialIterator(train_dataset, args.batchsize)
+        train_dataset = MovingMnistDataset(args.dataset, video_length, size)
+    elif args.dataset_type == "shards":
+        train_dataset = ShardDataset(args.dataset, video_length, args.shuffle_buffer)
+        num_labels = train_dataset.num_labels
+    elif args.dataset_type == "shm":
+        train_dataset = SharedMemoryDataset(args.dataset, video_length)
+        num_labels = train_dataset.num_labels
+
+    if args.dataset_type == "shards":
+        train_iter = ShardIterator(train_dataset, args.batchsize, args.loader_processes)
+    else:
+        train_iter = chainer.iterators.SerialIterator(train_dataset, args.batchsize)
 
     # Set up models
     if args.model == "normal":
         use_label = False
-        image_gen = ImageGenerator(dim_zc, dim_zm, num_labels, channel, n_filters_gen, video_length)
-        image_dis = ImageDiscriminator(channel, 1, n_filters_gen, use_noise, noise_sigma)
-        video_dis = VideoDiscriminator(channel, 1, n_filters_gen, use_noise, noise_sigma)
+        image_gen = ImageGenerator(dim_zc, dim_zm, num_labels, channel, n_filters_gen, video_length, args.progressive)
+        image_dis = ImageDiscriminator(channel, 1, n_filters_gen, use_noise, noise_sigma, args.progressive)
+        video_dis = VideoDiscriminator(channel, 1, n_filters_gen, use_noise, noise_sigma, args.progressive)
     elif args.model == "cgan":
         if num_labels == 0: raise ValueError("Called cgan model, but dataset has no label.")
         use_label = True
-        image_gen = ImageGenerator(dim_zc, dim_zm, num_labels, channel, n_filters_gen, video_length)
-        image_dis = ImageDiscriminator(channel+num_labels, 1, n_filters_gen, use_noise, noise_sigma)
-        video_dis = VideoDiscriminator(channel+num_labels, 1, n_filters_gen, use_noise, noise_sigma)
+        image_gen = ImageGenerator(dim_zc, dim_zm, num_labels, channel, n_filters_gen, video_length, args.progressive)
+        image_dis = ImageDiscriminator(channel+num_labels, 1, n_filters_gen, use_noise, noise_sigma, args.progressive)
+        video_dis = VideoDiscriminator(channel+num_labels, 1, n_filters_gen, use_noise, noise_sigma, args.progressive)
     elif args.model == "infogan":
         if num_labels == 0: raise ValueError("Called cgan model, but dataset has no label.")
         use_label = True
-        image_gen = ImageGenerator(dim_zc, dim_zm, num_labels, channel, n_filters_gen, video_length)
-        image_dis = ImageDiscriminator(channel, 1+num_labels, n_filters_gen, use_noise, noise_sigma)
-        video_dis = VideoDiscriminator(channel, 1+num_labels, n_filters_gen, use_noise, noise_sigma)
+        image_gen = ImageGenerator(dim_zc, dim_zm, num_labels, channel, n_filters_gen, video_length, args.progressive)
+        image_dis = ImageDiscriminator(channel, 1+num_labels, n_filters_gen, use_noise, noise_sigma, args.progressive)
+        video_dis = VideoDiscriminator(channel, 1+num_labels, n_filters_gen, use_noise, noise_sigma, args.progressive)
+
+    # select CPU kernels before the optimizers are set up, as links may be replaced
+    if args.backend != 'numpy' and args.gpu >= 0:
+        raise ValueError('--backend {} is CPU only'.format(args.backend))
+    backend = use_backend(args.backend)
+    kernels = [(net.name, select_kernels(net, backend)) for net in (image_gen, image_dis, video_dis)]
     
     if args.gpu >= 0:
         chainer.cuda.get_device_from_id(args.gpu).use()
@@ -101,7 +139,16 @@ def main():
     opt_video_dis = make_optimizer(video_dis, 2e-4, 5e-5, 0.999)
 
     # tensorboard writer
-    writer = SummaryWriter(Path('runs') / args.save_name)
+    if args.tensorboard_backend == 'tb_chainer':
+        from tb_chainer import SummaryWriter as TBChainerSummaryWriter
+        writer = TBChainerSummaryWriter(Path('runs') / args.save_name)
+    else:
+        writer = SummaryWriter(Path('runs') / args.save_name)
+
+    # augmentation of real videos
+    augmentation = None
+    if args.augment:
+        augmentation = VideoAugmentation.from_names(args.augment, args.crop_pad, args.brightness)
 
     # updater args
     updater_args = {
@@ -113,6 +160,7 @@ def main():
         "dim_zl":             num_labels,
         "iterator":           train_iter,
         "tensorboard_writer": writer,
+        "augmentation":       augmentation,
         "optimizer":          {
             'image_gen':      opt_image_gen,
             'image_dis':      opt_image_dis,
@@ -145,10 +193,11 @@ def main():
 
     # loss setting
     display_interval = (args.display_interval, 'epoch')
+    report_keys = ['epoch', 'iteration', 'image_gen/loss', 'image_dis/loss', 'video_dis/loss']
+    if args.fid_interval > 0:
+        report_keys += ['fid', 'fvd']
     trainer.extend(extensions.LogReport(trigger=display_interval))
-    trainer.extend(extensions.PrintReport([
-        'epoch', 'iteration', 'image_gen/loss', 'image_dis/loss', 'video_dis/loss'
-    ]), trigger=display_interval)
+    trainer.extend(extensions.PrintReport(report_keys), trigger=display_interval)
     trainer.extend(extensions.ProgressBar(update_interval=1))
 
     # tensorboard-chainer
@@ -159,21 +208,49 @@ def main():
         log_tensorboard(image_gen, args.num_gen_samples, video_length, writer),
         trigger=log_tensorboard_interval)
 
+    # fid / fvd
+    if args.fid_interval > 0:
+        extractor = FeatureExtractor(channel, args.fid_image_dis, args.fid_video_dis)
+        if args.gpu >= 0:
+            extractor.to_gpu()
+        evaluator = FrechetEvaluator(extractor, train_dataset, args.batchsize,
+                                     args.fid_cache, args.gpu)
+        trainer.extend(
+            frechet_evaluation(evaluator, image_gen, args.fid_samples, writer),
+            trigger=(args.fid_interval, 'epoch'))
+
+    # progressive training
+    if args.progressive:
+        schedule = ProgressiveSchedule(updater, args.stage_epochs, args.fade_epochs,
+                                       args.start_size, args.start_length, size, video_length)
+        trainer.extend(schedule)
+
     if args.resume:
         chainer.serializers.load_npz(args.resume, trainer)
+
+    if args.progressive:
+        schedule.apply(updater.epoch_detail)
     
     print('[ Training configuration ]')
     print('# gpu: {}'.format(args.gpu))
+    print('# backend: {}'.format(backend))
+    if backend != 'numpy':
+        for name, report in kernels:
+            print('#   {}: {}'.format(name, ', '.join('{}={}'.format(*r) for r in report)))
     print('# minibatch size: {}'.format(args.batchsize))
     print('# max epoch: {}'.format(args.max_epoch))
     print('# num batches: {}'.format(len(train_dataset) // args.batchsize))
     print('# data size: {}'.format(len(train_dataset)))
-    print('# data shape: {}'.format(train_dataset[0][0].shape))
+    print('# data shape: {}'.format((channel, video_length, size, size)))
     print('# num filters igen: {}'.format(n_filters_gen))
     print('# num filters idis: {}'.format(n_filters_idis))
     print('# num filters vdis: {}'.format(n_filters_vdis))
     print('# use noise: {}(sigma={})'.format(use_noise, noise_sigma))
     print('# use label: {}'.format(use_label))
+    if args.progressive:
+        print('# progressive: {}x{}, {} frames for {} epochs, fade in {} epochs'.format(
+            args.start_size, args.start_size, args.start_length, args.stage_epochs, args.fade_epochs))
+    print('# augmentation: {}'.format(', '.join(args.augment) or None))
     print('# snapshot interval: {}'.format(args.snapshot_interval))
     print('# log tensorboard interval: {}'.format(args.log_tensorboard_interval))
     print('# num generate samples: {}'.format(args.num_gen_samples))
@@ -181,6 +258,7 @@ def main():
     
     # start training
     trainer.run()
+    writer.close()
 
     if args.gpu >= 0:
         image_gen.to_cpu()
@@ -86,6 +86,40 @@ def save_video(video, save_path, save_frame=False, frame_path=Path("/tmp/mocogan
     if not save_frame:
         frame_path.rmdir()
 
+class VideoWriter(object):
+    """
+    Encode a video incrementally by piping raw frames to ffmpeg,
+    so arbitrarily long videos never have to be held in memory.
+    """
+    def __init__(self, save_path, height, width):
+        """
+        :param pathlib.Path save_path: path to save video
+        :param int height: frame height
+        :param int width: frame width
+        """
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+               '-s', '{}x{}'.format(width, height), '-r', '16', '-i', '-',
+               '-vcodec', 'libx264', '-pix_fmt', 'yuv420p', '-vf', 'setpts=PTS/0.5',
+               str(save_path)]
+        self.process = sp.Popen(cmd, stdin=sp.PIPE)
+
+    def write(self, frames):
+        """
+        :param np.ndarray frames: frames (dim=4, dtype=np.uint8, axis=(num, height, width, channel))
+        """
+        self.process.stdin.write(np.ascontiguousarray(frames).tobytes())
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
 def log_tensorboard(image_gen, num, video_length, writer):
     @chainer.training.make_extension()
     def log(trainer):
@@ -103,7 +137,7 @@ def log_tensorboard(image_gen, num, video_length, writer):
             grid_video = to_grid(videos, int(np.sqrt(num))) # (T, C, H, W)
             
             ## image shape: (C, H, W), value range: [0, 1.0]
-            for i in np.linspace(0, video_length, 4, endpoint=False, dtype=np.int):
+            for i in np.linspace(0, len(videos), 4, endpoint=False, dtype=np.int):
                 writer.add_image('{:02d}th frame'.format(i), grid_video[i], updater.epoch)
             
             # write videos as image